@@ -87,6 +87,8 @@ class LogIoUByClass(Callback):
         dataloader_idx: int,
     ):
         """Log IoU for each class. Loop in case of multiple files in a single batch."""
+        if outputs is None:
+            return
         interpolations = self.itp.update(outputs)
         for logits, targets in interpolations:
             self.log_iou(logits, targets, "test", self.test_iou_by_class_dict)
@@ -1,16 +1,25 @@
+import copy
+import functools
+import math
 import os.path as osp
 import glob
 import time
 import numpy as np
-from typing import Optional, List, AnyStr
+from typing import Dict, Optional, List, AnyStr
 from numbers import Number
 from pytorch_lightning import LightningDataModule
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, get_worker_info
 from torch.utils.data.dataset import IterableDataset
 from torch_geometric.transforms import RandomFlip
 from torch_geometric.data.data import Data
 from torch_geometric.transforms.center import Center
 from lidar_multiclass.utils import utils
+from lidar_multiclass.data.loading import (
+    PRESAMPLED_VAL_DIRNAME,
+    SHARDS_DIRNAME,
+    get_presampling_metadata,
+    load_shard,
+)
 from lidar_multiclass.data.transforms import *
 
 from lidar_multiclass.utils import utils
@@ -38,6 +47,9 @@ class DataModule(LightningDataModule):
         self.batch_size = kwargs.get("batch_size", 32)
         self.augment = kwargs.get("augment", True)
         self.subsampler = kwargs.get("subsampler")
+        self.batch_transforms_on_device = kwargs.get("batch_transforms_on_device", False)
+        self.use_presampled_val = kwargs.get("use_presampled_val", True)
+        self.pin_memory = kwargs.get("pin_memory", False) and torch.cuda.is_available()
 
         self.dataset_description = kwargs.get("dataset_description")
         self.classification_dict = self.dataset_description.get("classification_dict")
@@ -67,34 +79,88 @@ class DataModule(LightningDataModule):
 
     def _set_train_data(self):
         """Sets the train dataset from a directory."""
-        files = glob.glob(
-            osp.join(self.prepared_data_dir, "train", "**", "*.data"), recursive=True
-        )
-        self.train_data = LidarMapDataset(
-            files,
-            loading_function=torch.load,
-            transform=self._get_train_transforms(),
-            target_transform=TargetTransform(
-                self.classification_preprocessing_dict,
-                self.classification_dict,
-            ),
+        self.train_data = self._get_prepared_dataset(
+            "train", self._get_train_transforms()
         )
 
     def _set_val_data(self):
-        """Sets the validation dataset from a directory."""
+        """Sets the validation dataset from a directory.
 
-        files = glob.glob(
-            osp.join(self.prepared_data_dir, "val", "**", "*.data"), recursive=True
+        Val subtiles presampled via loading.py are used as is when they were subsampled like the subsampler of
+        the datamodule would, so that validation epochs skip subsampling.
+
+        """
+        shard_dirs = self._get_presampled_val_shard_dirs()
+        if shard_dirs:
+            self.val_data = self._get_prepared_dataset(
+                PRESAMPLED_VAL_DIRNAME,
+                self._get_presampled_val_transforms(),
+                shard_dirs=shard_dirs,
+            )
+            log.info(f"Validation on {len(self.val_data)} presampled subtiles.")
+            return
+        self.val_data = self._get_prepared_dataset("val", self._get_val_transforms())
+        log.info(f"Validation on {len(self.val_data)} subtiles.")
+
+    def _get_presampled_val_shard_dirs(self) -> List[str]:
+        """Gets the shards of presampled val subtiles, if any and if they match the subsampler."""
+        if not self.use_presampled_val:
+            return []
+        shard_dirs = sorted(
+            glob.glob(
+                osp.join(
+                    self.prepared_data_dir,
+                    PRESAMPLED_VAL_DIRNAME,
+                    SHARDS_DIRNAME,
+                    "shard_*",
+                )
+            )
+        )
+        if not shard_dirs:
+            return []
+        expected = get_presampling_metadata(self.subsampler)
+        for shard_dir in shard_dirs:
+            presampling = load_shard(shard_dir, mmap_mode="r")[2].get("presampling")
+            if presampling != expected:
+                log.warning(
+                    f"Presampled val data in {shard_dir} ({presampling}) do not match the subsampler "
+                    f"({expected}). Subsampling val data at each epoch instead."
+                )
+                return []
+        return shard_dirs
+
+    def _get_prepared_dataset(
+        self,
+        phase: str,
+        transform: CustomCompose,
+        shard_dirs: Optional[List[str]] = None,
+    ) -> Dataset:
+        """Gets a dataset of subtiles prepared via loading.py, for train or val phase.
+
+        Subtiles packed into shards are read through memory-mapped views when present.
+        Otherwise, subtiles are loaded from individual `.data` files.
+
+        """
+        phase_dir = osp.join(self.prepared_data_dir, phase)
+        target_transform = TargetTransform(
+            self.classification_preprocessing_dict,
+            self.classification_dict,
         )
-        log.info(f"Validation on {len(files)} subtiles.")
-        self.val_data = LidarMapDataset(
+        if shard_dirs is None:
+            shard_dirs = sorted(
+                glob.glob(osp.join(phase_dir, SHARDS_DIRNAME, "shard_*"))
+            )
+        if shard_dirs:
+            return LidarShardDataset(
+                shard_dirs, transform=transform, target_transform=target_transform
+            )
+
+        files = glob.glob(osp.join(phase_dir, "**", "*.data"), recursive=True)
+        return LidarMapDataset(
             files,
             loading_function=torch.load,
-            transform=self._get_val_transforms(),
-            target_transform=TargetTransform(
-                self.classification_preprocessing_dict,
-                self.classification_dict,
-            ),
+            transform=transform,
+            target_transform=target_transform,
         )
 
     def _set_test_data(self):
@@ -112,6 +178,7 @@ class DataModule(LightningDataModule):
             ),
             subtile_width_meters=self.subtile_width_meters,
             subtile_overlap=self.subtile_overlap,
+            batch_size=self.batch_size,
         )
 
     def _set_predict_data(self, files: List[str]):
@@ -120,13 +187,18 @@ class DataModule(LightningDataModule):
         NB: the single fgile should be in a list.
 
         """
-        self.predict_data = LidarIterableDataset(
+        self.predict_data = self._get_predict_data(files)
+
+    def _get_predict_data(self, files: List[str]) -> "LidarIterableDataset":
+        """Gets predict data from a list of files, without setting it."""
+        return LidarIterableDataset(
             files,
             loading_function=self.load_las,
             transform=self._get_predict_transforms(),
             target_transform=None,
             subtile_width_meters=self.subtile_width_meters,
             subtile_overlap=self.subtile_overlap,
+            batch_size=self.batch_size,
         )
 
     def train_dataloader(self):
@@ -136,8 +208,10 @@ class DataModule(LightningDataModule):
             batch_size=self.batch_size,
             shuffle=True,
             num_workers=self.num_workers,
-            collate_fn=collate_fn,
+            collate_fn=self._get_collate_fn(),
             prefetch_factor=1,
+            persistent_workers=self.num_workers > 0,
+            pin_memory=self.pin_memory and self.num_workers > 0,
         )
 
     def val_dataloader(self):
@@ -147,22 +221,26 @@ class DataModule(LightningDataModule):
             batch_size=self.batch_size,
             shuffle=False,
             num_workers=self.num_workers,
-            collate_fn=collate_fn,
+            collate_fn=self._get_collate_fn(),
             prefetch_factor=1,
+            persistent_workers=self.num_workers > 0,
+            pin_memory=self.pin_memory and self.num_workers > 0,
         )
 
     def test_dataloader(self):
         """Sets test dataloader.
 
         The dataloader will produces batches of prepared subtiles from a single tile (point cloud).
+        With several workers, test tiles are loaded in shared memory one at a time (see TileByTileDataLoader).
 
         """
-        return DataLoader(
+        dataloader_class = TileByTileDataLoader if self.num_workers > 1 else DataLoader
+        return dataloader_class(
             dataset=self.test_data,
             batch_size=self.batch_size,
             shuffle=False,
-            num_workers=1,
-            collate_fn=collate_fn,
+            num_workers=max(self.num_workers, 1),
+            collate_fn=self._get_collate_fn(),
             prefetch_factor=1,
         )
 
@@ -170,51 +248,124 @@ class DataModule(LightningDataModule):
         """Sets predict dataloader.
 
         The dataloader will produces batches of prepared subtiles from a single tile (point cloud).
+        With several workers, tiles are loaded in shared memory one at a time (see TileByTileDataLoader).
 
         """
-        return DataLoader(
+        dataloader_class = TileByTileDataLoader if self.num_workers > 1 else DataLoader
+        return dataloader_class(
             dataset=self.predict_data,
             batch_size=self.batch_size,
             shuffle=False,
-            num_workers=1,  # b/c terable dataloader
-            collate_fn=collate_fn,
+            num_workers=max(self.num_workers, 1),
+            collate_fn=self._get_collate_fn(),
             prefetch_factor=1,
         )
 
     def _set_all_transforms(self):
         """Set transforms that are shared between train/val-test.
 
+        Samples are centered, augmented and normalized one by one in dataloader workers. With
+        batch_transforms_on_device, they are instead centered, augmented and normalized on the training device,
+        once collated into batches (see BatchCenter and on_after_batch_transfer).
+
+        Indices and targets of full resolution points (see KeepFullResolutionIdxAndY) and copies of subsampled
+        positions are only needed to interpolate predictions, and are thus only kept at test and predict time:
+        train and val batches only hold what the model step uses.
+
         Nota: Called at initialization.
         """
 
-        self.preparation = [
-            EmptySubtileFilter(),
-            ToTensor(),
-            MakeCopyOfPosAndY(),
+        self.loading = [EmptySubtileFilter(), ToTensor()]
+        self.preparation = self.loading + [self.subsampler]
+        self.interpolation_preparation = self.loading + [
+            KeepFullResolutionIdxAndY(),
             self.subsampler,
             MakeCopyOfSampledPos(),
-            Center(),
         ]
-        self.augmentation = []
-        if self.augment:
-            self.augmentation = [RandomFlip(0, p=0.5), RandomFlip(1, p=0.5)]
-        self.normalization = [NormalizePos(), StandardizeFeatures()]
+        if self.batch_transforms_on_device:
+            self.centering = [BatchCenter()]
+            self.augmentation = []
+            if self.augment:
+                self.augmentation = [
+                    BatchRandomFlip(0, p=0.5),
+                    BatchRandomFlip(1, p=0.5),
+                ]
+            self.normalization = [BatchNormalizePos(), BatchStandardizeFeatures()]
+        else:
+            self.centering = [Center()]
+            self.augmentation = []
+            if self.augment:
+                self.augmentation = [RandomFlip(0, p=0.5), RandomFlip(1, p=0.5)]
+            self.normalization = [NormalizePos(), StandardizeFeatures()]
 
     def _get_train_transforms(self) -> CustomCompose:
         """Creates a transform composition for train phase."""
-        return CustomCompose(self.preparation + self.augmentation + self.normalization)
+        return self._get_sample_transforms(
+            self.preparation, self.centering + self.augmentation + self.normalization
+        )
 
     def _get_val_transforms(self) -> CustomCompose:
         """Creates a transform composition for val phase."""
-        return CustomCompose(self.preparation + self.normalization)
+        return self._get_sample_transforms(
+            self.preparation, self.centering + self.normalization
+        )
+
+    def _get_presampled_val_transforms(self) -> CustomCompose:
+        """Creates a transform composition for val phase, on val data presampled via loading.py."""
+        return self._get_sample_transforms(
+            self.loading, self.centering + self.normalization
+        )
 
     def _get_test_transforms(self) -> CustomCompose:
         """Creates a transform composition for test phase."""
-        return self._get_val_transforms()
+        return self._get_sample_transforms(
+            self.interpolation_preparation, self.centering + self.normalization
+        )
 
     def _get_predict_transforms(self) -> CustomCompose:
         """Creates a transform composition for predict phase."""
-        return self._get_val_transforms()
+        return self._get_test_transforms()
+
+    def _get_sample_transforms(
+        self, preparation: List, transforms: List
+    ) -> CustomCompose:
+        """Creates a transform composition of samples in dataloader workers: preparation, then transforms unless
+        they are applied to batches on device."""
+        if self.batch_transforms_on_device:
+            return CustomCompose(preparation)
+        return CustomCompose(preparation + transforms)
+
+    def _get_train_batch_transforms(self) -> CustomCompose:
+        """Creates a batch transform composition for train phase, applied on device."""
+        return CustomCompose(self.centering + self.augmentation + self.normalization)
+
+    def _get_val_batch_transforms(self) -> CustomCompose:
+        """Creates a batch transform composition for val, test and predict phases, applied on device."""
+        return CustomCompose(self.centering + self.normalization)
+
+    def _get_collate_fn(self):
+        """Get the collate function of a dataloader.
+
+        Without workers, batches are collated in pinned memory if pin_memory is set. With workers, they are
+        pinned by the DataLoader.
+
+        """
+        return functools.partial(
+            collate_fn,
+            pin_memory=self.pin_memory and self.num_workers == 0,
+        )
+
+    def on_after_batch_transfer(self, batch, dataloader_idx: int):
+        """Apply batch transforms once batches are on device, if batch_transforms_on_device is set.
+
+        Called by the Trainer. At predict time, call it on batches moved to device.
+
+        """
+        if not self.batch_transforms_on_device or batch is None:
+            return batch
+        if self.trainer is not None and self.trainer.training:
+            return self._get_train_batch_transforms()(batch)
+        return self._get_val_batch_transforms()(batch)
 
 
 class LidarMapDataset(Dataset):
@@ -252,8 +403,93 @@ class LidarMapDataset(Dataset):
         return self.num_files
 
 
+class LidarShardDataset(Dataset):
+    """A Dataset to load subtiles packed in shards as produced via loading.py.
+
+    Shards are memory-mapped, so that subtiles are zero-copy views of the files.
+    Memory-maps are opened lazily in each process and are never pickled: DataLoader workers
+    share the OS page cache instead of each holding a private copy of the data.
+
+    """
+
+    def __init__(
+        self,
+        shard_dirs: List[str],
+        transform=None,
+        target_transform=None,
+    ):
+        self.shard_dirs = shard_dirs
+        self.offsets = []
+        self.metadata = []
+        for shard_dir in shard_dirs:
+            _, offsets, metadata = load_shard(shard_dir, mmap_mode="r")
+            self.offsets.append(offsets)
+            self.metadata.append(metadata)
+        self._arrays = None
+
+        num_subtiles_by_shard = [len(offsets) - 1 for offsets in self.offsets]
+        self.shards_first_idx = np.cumsum([0] + num_subtiles_by_shard)
+        # Within a shard, index of the first subtile of the next file.
+        self.files_end_idx = [
+            np.cumsum(metadata["num_subtiles_by_file"]) for metadata in self.metadata
+        ]
+
+        self.transform = transform
+        self.target_transform = target_transform
+
+    @property
+    def arrays(self) -> List[Dict[str, np.ndarray]]:
+        """Memory-mapped arrays of each shard, opened on first access in the current process."""
+        if self._arrays is None:
+            self._arrays = [load_shard(shard_dir)[0] for shard_dir in self.shard_dirs]
+        return self._arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def __getitem__(self, idx):
+        """Gets a subtile from its shard and transforms its features and targets."""
+        shard_idx = np.searchsorted(self.shards_first_idx, idx, side="right") - 1
+        arrays = self.arrays[shard_idx]
+        offsets = self.offsets[shard_idx]
+        metadata = self.metadata[shard_idx]
+        subtile_idx = idx - self.shards_first_idx[shard_idx]
+        file_idx = np.searchsorted(
+            self.files_end_idx[shard_idx], subtile_idx, side="right"
+        )
+        start, end = offsets[subtile_idx], offsets[subtile_idx + 1]
+
+        data = Data(
+            pos=arrays["pos"][start:end],
+            x=arrays["x"][start:end],
+            y=arrays["y"][start:end],
+            las_filepath=metadata["las_filepaths"][file_idx],
+            x_features_names=metadata["x_features_names"],
+        )
+        if self.transform:
+            data = self.transform(data)
+        if data is None:
+            return None
+        if self.target_transform:
+            data = self.target_transform(data)
+
+        return data
+
+    def __len__(self):
+        return int(self.shards_first_idx[-1])
+
+
 class LidarIterableDataset(IterableDataset):
-    """A Dataset to load a full point cloud, batch by batch."""
+    """A Dataset to load a full point cloud, batch by batch.
+
+    With multiple DataLoader workers, subtiles of each file are dealt to workers by blocks of batch_size,
+    in turn. Filtered-out subtiles are replaced by None, and each worker yields as many items for each
+    file, so that batches come out of the DataLoader in the same order as with a single worker.
+    Tiles can be loaded once in shared memory beforehand, to be read by all workers without copies.
+
+    """
 
     def __init__(
         self,
@@ -263,6 +499,7 @@ class LidarIterableDataset(IterableDataset):
         target_transform=None,
         subtile_width_meters: Number = 50,
         subtile_overlap: Number = 0,
+        batch_size: int = 1,
     ):
         self.files = files
         self.loading_function = loading_function
@@ -270,28 +507,103 @@ class LidarIterableDataset(IterableDataset):
         self.target_transform = target_transform
         self.subtile_width_meters = subtile_width_meters
         self.subtile_overlap = subtile_overlap
+        self.batch_size = batch_size
+        self.shared_tiles = {}
 
     def yield_transformed_subtile_data(self):
         """Yield subtiles from all tiles in an exhaustive fashion."""
+        worker_info = get_worker_info()
+        num_workers = worker_info.num_workers if worker_info else 1
+        worker_id = worker_info.id if worker_info else 0
 
         for idx, filepath in enumerate(self.files):
-            log.info(f"Parsing file {idx+1}/{len(self.files)} [{filepath}]")
-            tile_data = self.loading_function(filepath)
+            if worker_id == 0:
+                log.info(f"Parsing file {idx+1}/{len(self.files)} [{filepath}]")
+            tile_data, grid_index = self.get_tile(filepath)
             centers = self.get_all_subtiles_xy_min_corner(tile_data)
+            centers = self.get_worker_share(centers, worker_id, num_workers)
             # TODO: change to process time function
             ts = time.time()
             for xy_min_corner in centers:
-                data = self.extract_subtile_from_tile_data(tile_data, xy_min_corner)
+                if xy_min_corner is None:
+                    yield None
+                    continue
+                data = self.extract_subtile_from_tile_data(
+                    tile_data, xy_min_corner, grid_index
+                )
                 if self.transform:
                     data = self.transform(data)
                 if data is not None:
                     if self.target_transform:
                         data = self.target_transform(data)
                     yield data
+                elif num_workers > 1:
+                    # Keep workers in lockstep.
+                    yield None
 
     def __iter__(self):
         return self.yield_transformed_subtile_data()
 
+    def get_worker_share(self, items: list, worker_id: int, num_workers: int) -> list:
+        """Get the items of a file to be processed by a worker.
+
+        Items are grouped in blocks of batch_size, dealt to workers in turn. Blocks are padded with None,
+        and so is the number of blocks, so that all workers get the same number of items.
+
+        """
+        if num_workers == 1:
+            return items
+        num_blocks = math.ceil(len(items) / self.batch_size)
+        num_blocks = math.ceil(num_blocks / num_workers) * num_workers
+        share = []
+        for block_idx in range(worker_id, num_blocks, num_workers):
+            block = items[block_idx * self.batch_size : (block_idx + 1) * self.batch_size]
+            share += block + [None] * (self.batch_size - len(block))
+        return share
+
+    def get_tile(self, filepath: str):
+        """Get a tile and its grid index, from shared memory if it was loaded there.
+
+        Returns:
+            Data, TileGridIndex: the tile data, with numpy arrays, and its grid index.
+
+        """
+        if filepath not in self.shared_tiles:
+            tile_data = self.loading_function(filepath)
+            grid_index = TileGridIndex(
+                tile_data.pos, cell_size=self.subtile_width_meters - self.subtile_overlap
+            )
+            return tile_data, grid_index
+
+        shared_tile_data, shared_grid_index = self.shared_tiles[filepath]
+        tile_data = Data()
+        for key in shared_tile_data.keys:
+            value = shared_tile_data[key]
+            tile_data[key] = value.numpy() if torch.is_tensor(value) else value
+        grid_index = copy.copy(shared_grid_index)
+        grid_index.order = shared_grid_index.order.numpy()
+        grid_index.cell_offsets = shared_grid_index.cell_offsets.numpy()
+        return tile_data, grid_index
+
+    def load_tiles_in_shared_memory(self):
+        """Load all tiles and their grid index in shared memory, before DataLoader workers are started.
+
+        Note that this holds all tiles in memory at once: use TileByTileDataLoader to share them one at a time.
+
+        """
+        for filepath in self.files:
+            if filepath in self.shared_tiles:
+                continue
+            log.info(f"Loading {filepath} in shared memory.")
+            tile_data, grid_index = self.get_tile(filepath)
+            for key in ["pos", "x", "y"]:
+                tile_data[key] = torch.from_numpy(tile_data[key]).share_memory_()
+            grid_index.order = torch.from_numpy(grid_index.order).share_memory_()
+            grid_index.cell_offsets = torch.from_numpy(
+                grid_index.cell_offsets
+            ).share_memory_()
+            self.shared_tiles[filepath] = (tile_data, grid_index)
+
     def get_all_subtiles_xy_min_corner(self, data: Data):
         """Get centers of square subtiles of specified width, assuming rectangular form of input cloud."""
 
@@ -313,20 +625,117 @@ class LidarIterableDataset(IterableDataset):
         # random.shuffle(centers)
         return xy_min_corners
 
-    def extract_subtile_from_tile_data(self, data: Data, low_xy):
+    def extract_subtile_from_tile_data(
+        self, data: Data, low_xy, grid_index: "TileGridIndex"
+    ) -> Data:
         """Extract the subset from xy_min_corner to xy_min_corner + self.subtile_width_meters
 
+        Only points in grid cells intersecting the subtile are considered, so that the cost
+        of the extraction is proportional to the number of points in the subtile.
+
         Args:
             tile_data (Data): The full tile data.
             xy_min_corner (np.array): Coordonates of xy min corner of subtile to extract.
+            grid_index (TileGridIndex): Index of the tile points.
+
         """
         high_xy = low_xy + self.subtile_width_meters
-        mask_x = (low_xy[0] <= data.pos[:, 0]) & (data.pos[:, 0] <= high_xy[0])
-        mask_y = (low_xy[1] <= data.pos[:, 1]) & (data.pos[:, 1] <= high_xy[1])
-        mask = mask_x & mask_y
-
-        sub = data.clone()
-        sub.pos = sub.pos[mask]
-        sub.x = sub.x[mask]
-        sub.y = sub.y[mask]
+        idx = grid_index.query(low_xy, high_xy)
+        pos = data.pos[idx]
+        mask_x = (low_xy[0] <= pos[:, 0]) & (pos[:, 0] <= high_xy[0])
+        mask_y = (low_xy[1] <= pos[:, 1]) & (pos[:, 1] <= high_xy[1])
+        idx = idx[mask_x & mask_y]
+
+        sub = Data()
+        for key in data.keys:
+            sub[key] = data[key][idx] if key in ["pos", "x", "y"] else data[key]
+        # Index of the points in the tile, to merge predictions of overlapping windows point by point.
+        sub.point_idx = idx
+        # Windows are yielded in x-major order, which lets the Interpolator finalize points as it goes.
+        sub.xy_min_corner = low_xy
         return sub
+
+
+class TileByTileDataLoader(DataLoader):
+    """A DataLoader over a LidarIterableDataset, which holds a single tile in shared memory at a time.
+
+    For each file, the tile and its grid index are loaded in shared memory in the main process, and
+    its subtiles are dealt to the workers of a DataLoader over this file only. The tile is released
+    once its subtiles are consumed, so that peak memory does not grow with the number of files.
+
+    """
+
+    def __iter__(self):
+        dataset = self.dataset
+        for filepath in dataset.files:
+            tile_dataset = copy.copy(dataset)
+            tile_dataset.files = [filepath]
+            # A tile may already be in shared memory, if it was loaded there beforehand.
+            tile_dataset.shared_tiles = {}
+            if filepath in dataset.shared_tiles:
+                tile_dataset.shared_tiles[filepath] = dataset.shared_tiles.pop(filepath)
+            tile_dataset.load_tiles_in_shared_memory()
+            yield from DataLoader(
+                dataset=tile_dataset,
+                batch_size=self.batch_size,
+                num_workers=self.num_workers,
+                collate_fn=self.collate_fn,
+                pin_memory=self.pin_memory,
+                worker_init_fn=self.worker_init_fn,
+                prefetch_factor=self.prefetch_factor,
+            )
+
+
+class TileGridIndex:
+    """Index of the points of a tile by the cells of a regular xy grid, in CSR format.
+
+    Cells are numbered in x-major order, and the indices of the points in cell c are
+    order[cell_offsets[c]:cell_offsets[c+1]]. The index is built once per tile, in a single sort.
+
+    """
+
+    def __init__(self, pos: np.ndarray, cell_size: Number):
+        """Build the index.
+
+        Args:
+            pos (np.ndarray): (N, 3) positions of the tile points.
+            cell_size (Number): width of the square cells, typically the stride of the sliding window.
+
+        """
+        self.cell_size = cell_size
+        xy = pos[:, :2].astype(np.float64)
+        self.low = xy.min(0)
+        self.num_cells = self._get_cell_xy(xy.max(0)) + 1
+
+        cell_idx = self._get_cell_xy(xy)
+        cell_idx = cell_idx[:, 0] * self.num_cells[1] + cell_idx[:, 1]
+        self.order = np.argsort(cell_idx, kind="stable")
+        self.cell_offsets = np.zeros(self.num_cells.prod() + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(cell_idx, minlength=self.num_cells.prod()),
+            out=self.cell_offsets[1:],
+        )
+
+    def query(self, low_xy: np.ndarray, high_xy: np.ndarray) -> np.ndarray:
+        """Get the sorted indices of the points in cells intersecting [low_xy, high_xy].
+
+        This is a superset of the points in [low_xy, high_xy], which still need to be filtered.
+
+        """
+        low_cell = np.maximum(self._get_cell_xy(np.asarray(low_xy)), 0)
+        high_cell = np.minimum(self._get_cell_xy(np.asarray(high_xy)), self.num_cells - 1)
+        if (low_cell > high_cell).any():
+            return np.empty(0, dtype=np.int64)
+        slices = [
+            self.order[
+                self.cell_offsets[ix * self.num_cells[1] + low_cell[1]] : self.cell_offsets[
+                    ix * self.num_cells[1] + high_cell[1] + 1
+                ]
+            ]
+            for ix in range(low_cell[0], high_cell[0] + 1)
+        ]
+        return np.sort(np.concatenate(slices))
+
+    def _get_cell_xy(self, xy: np.ndarray) -> np.ndarray:
+        """Get the (ix, iy) cell of xy positions (not clipped to the grid)."""
+        return np.floor((xy - self.low) / self.cell_size).astype(np.int64)
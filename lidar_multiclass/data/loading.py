@@ -12,8 +12,12 @@ In particular, subclasses implement a "load_las" method that is used by the data
 from abc import ABC, abstractmethod
 import argparse
 import os, glob
+import json
+import zlib
 import os.path as osp
-from shutil import copyfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from shutil import copyfile, rmtree
+from typing import Dict, List, Optional, Tuple, Union
 from tqdm import tqdm
 import laspy
 import numpy as np
@@ -21,6 +25,12 @@ import pandas as pd
 import torch
 from torch_geometric.data import Data
 
+from lidar_multiclass.data.transforms import (
+    CustomGridSampler,
+    EmptySubtileFilter,
+    Subsampler,
+)
+
 
 class LidarDataLogic(ABC):
     """Abstract class to load, chunk, and save a point cloud dataset according to a train/val/test split.
@@ -32,13 +42,20 @@ class LidarDataLogic(ABC):
     input_tile_width_meters = 1000
     subtile_width_meters = 50
     return_num_normalization_max_value = 7
+    # Empty file written once all subtiles of a tile are saved, to make preparation resumable.
+    completion_flag_filename = ".complete"
 
     def __init__(self, **kwargs):
         self.input_data_dir = kwargs.get("input_data_dir")
         self.prepared_data_dir = kwargs.get("prepared_data_dir")
         self.split_csv = kwargs.get("split_csv")
-        self.range_by_axis = np.arange(
-            self.input_tile_width_meters // self.subtile_width_meters + 1
+        self.workers = kwargs.get("workers", 1)
+        self.output_format = kwargs.get("output_format", "data")
+        self.points_per_shard = kwargs.get("points_per_shard", 100_000_000)
+        self.presample_val = kwargs.get("presample_val", False)
+        self.presampler = CustomGridSampler(
+            subsample_size=kwargs.get("presampling_subsample_size", 12500),
+            voxel_size=kwargs.get("presampling_voxel_size", 0.25),
         )
 
     @abstractmethod
@@ -63,53 +80,186 @@ class LidarDataLogic(ABC):
 
         train/val:
             Load LAS into memory as a Data object with selected features,
-            then iteratively extract 50m*50m subtiles by filtering along x
-            then y axis. Serialize the resulting Data object using torch.save.
+            then extract 50m*50m subtiles by binning points on a regular xy grid
+            in a single pass. Serialize the resulting Data object using torch.save,
+            or, with output_format="shards", pack subtiles of all files into a few
+            large shards (see. save_shard and pack_shards).
 
         test:
             Simply copy the LAS to the new test folder.
 
+        With presample_val=True, val subtiles are also subsampled once and for all, and saved as shards
+        in a val_presampled folder (see. presample_and_save).
+
+        Files are spread across a pool of `workers` processes if workers > 1.
+        Files whose outputs are already complete are skipped, so that an interrupted
+        preparation can be resumed by running it again.
+
         """
         split_df = pd.read_csv(self.split_csv)
-        for phase in tqdm(self.split, desc="Phases"):
+        jobs = []
+        for phase in self.split:
             basenames = split_df[split_df.split == phase].basename.tolist()
             print(f"Subset: {phase}")
             print("  -  ".join(basenames))
-            for file_basename in tqdm(basenames, desc="Files"):
-                filepath = self._find_file_in_dir(self.input_data_dir, file_basename)
-                output_subdir_path = osp.join(self.prepared_data_dir, phase)
-                if phase == "test":
-                    os.makedirs(output_subdir_path, exist_ok=True)
-                    target_file = osp.join(output_subdir_path, file_basename)
-                    copyfile(filepath, target_file)
-                elif phase in ["train", "val"]:
-                    output_subdir_path = osp.join(
-                        output_subdir_path, osp.basename(filepath)
+            jobs += [(phase, file_basename) for file_basename in basenames]
+
+        if self.workers <= 1:
+            for phase, file_basename in tqdm(jobs, desc="Files"):
+                status = self.prepare_file(phase, file_basename)
+                tqdm.write(f"[{phase}] {file_basename}: {status}")
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                futures = {
+                    executor.submit(self.prepare_file, phase, file_basename): (
+                        phase,
+                        file_basename,
                     )
-                    os.makedirs(output_subdir_path, exist_ok=True)
-                    self.split_and_save(filepath, output_subdir_path)
-                else:
-                    raise KeyError("Phase should be one of train/val/test.")
+                    for phase, file_basename in jobs
+                }
+                for future in tqdm(
+                    as_completed(futures), total=len(jobs), desc="Files"
+                ):
+                    phase, file_basename = futures[future]
+                    status = future.result()
+                    tqdm.write(f"[{phase}] {file_basename}: {status}")
+
+        if self.output_format == "shards":
+            for phase in ["train", "val"]:
+                pack_shards(
+                    osp.join(self.prepared_data_dir, phase), self.points_per_shard
+                )
+        if self.presample_val:
+            pack_shards(
+                osp.join(self.prepared_data_dir, PRESAMPLED_VAL_DIRNAME),
+                self.points_per_shard,
+            )
+
+    def prepare_file(self, phase: str, file_basename: str) -> str:
+        """Prepare a single LAS file for the given phase, unless its outputs are already complete.
 
-    def split_and_save(self, filepath: str, output_subdir_path: str) -> None:
+        Args:
+            phase (str): one of train/val/test.
+            file_basename (str): basename of the LAS file, as listed in the split csv.
+
+        Returns:
+            str: "skipped" if outputs were already complete, "prepared" otherwise.
+
+        """
+        filepath = self._find_file_in_dir(self.input_data_dir, file_basename)
+        output_subdir_path = osp.join(self.prepared_data_dir, phase)
+        if phase == "test":
+            os.makedirs(output_subdir_path, exist_ok=True)
+            target_file = osp.join(output_subdir_path, file_basename)
+            if osp.isfile(target_file) and osp.getsize(target_file) == osp.getsize(
+                filepath
+            ):
+                return "skipped"
+            copyfile(filepath, target_file)
+        elif phase in ["train", "val"]:
+            output_subdir_paths = [
+                osp.join(output_subdir_path, osp.basename(filepath))
+            ]
+            if phase == "val" and self.presample_val:
+                output_subdir_paths.append(
+                    osp.join(
+                        self.prepared_data_dir,
+                        PRESAMPLED_VAL_DIRNAME,
+                        osp.basename(filepath),
+                    )
+                )
+            completion_flags = [
+                osp.join(path, self.completion_flag_filename)
+                for path in output_subdir_paths
+            ]
+            if all(osp.isfile(flag) for flag in completion_flags):
+                return "skipped"
+            # Start from scratch to remove leftovers of an interrupted preparation.
+            for path in output_subdir_paths:
+                if osp.isdir(path):
+                    rmtree(path)
+                os.makedirs(path)
+            self.split_and_save(filepath, *output_subdir_paths)
+            for flag in completion_flags:
+                open(flag, "w").close()
+        else:
+            raise KeyError("Phase should be one of train/val/test.")
+        return "prepared"
+
+    def split_and_save(
+        self,
+        filepath: str,
+        output_subdir_path: str,
+        presampled_subdir_path: Optional[str] = None,
+    ) -> None:
         """Parse a LAS, extract and save each subtile as a Data object.
 
         Args:
             filepath (str): input LAS file
             output_subdir_path (str): output directory to save splitted `.data` objects.
+            presampled_subdir_path (str, optional): output directory to also save subsampled subtiles
+            (see. presample_and_save).
         """
         data = self.load_las(filepath)
-        idx = 0
-        for _ in tqdm(self.range_by_axis):
-            if len(data.pos) == 0:
-                break
-            data_x_band = self._extract_by_x(data)
-            for _ in self.range_by_axis:
-                if len(data_x_band.pos) == 0:
-                    break
-                subtile_data = self._extract_by_y(data_x_band)
-                self._save(subtile_data, output_subdir_path, idx)
-                idx += 1
+        offsets = self._sort_by_subtile(data)
+        if presampled_subdir_path:
+            self.presample_and_save(data, offsets, presampled_subdir_path)
+        if self.output_format == "shards":
+            # Subtiles are packed into shards once all files of a split are prepared.
+            metadata = {
+                "las_filepath": data.las_filepath,
+                "x_features_names": list(data.x_features_names),
+            }
+            save_shard(data, offsets, metadata, output_subdir_path)
+            return
+
+        for idx, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+            subtile_data = Data(
+                pos=data.pos[start:end],
+                x=data.x[start:end],
+                y=data.y[start:end],
+                las_filepath=data.las_filepath,
+                x_features_names=data.x_features_names,
+            )
+            self._save(subtile_data, output_subdir_path, idx)
+
+    def presample_and_save(
+        self, data: Data, offsets: np.ndarray, output_subdir_path: str
+    ) -> None:
+        """Subsample each subtile of a tile with presampler, and save them as a shard.
+
+        This is the subsampling that happens at each validation epoch otherwise. Its final random up or
+        downsampling is seeded by the tile basename, so that presampled data do not depend on the order
+        in which files are prepared.
+
+        Args:
+            data (Data): tile, sorted by subtile (see. _sort_by_subtile).
+            offsets (np.ndarray): offsets of subtiles in data.
+            output_subdir_path (str): output directory of the shard.
+
+        """
+        torch.manual_seed(zlib.crc32(osp.basename(data.las_filepath).encode()))
+        subtiles = []
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            subtile_data = Data(
+                pos=torch.from_numpy(data.pos[start:end]),
+                x=torch.from_numpy(data.x[start:end]),
+                y=torch.from_numpy(data.y[start:end]),
+            )
+            subtile_data = EmptySubtileFilter()(subtile_data)
+            if subtile_data is not None:
+                subtiles.append(self.presampler(subtile_data))
+        arrays = {
+            key: torch.cat([subtile[key] for subtile in subtiles]).numpy()
+            for key in SHARD_KEYS
+        }
+        metadata = {
+            "las_filepath": data.las_filepath,
+            "x_features_names": list(data.x_features_names),
+            "presampling": get_presampling_metadata(self.presampler),
+        }
+        new_offsets = np.cumsum([0] + [subtile.num_nodes for subtile in subtiles])
+        save_shard(arrays, new_offsets, metadata, output_subdir_path)
 
     def _find_file_in_dir(self, input_data_dir: str, basename: str) -> str:
         """Query files with .las extension in subfolder of input_data_dir.
@@ -125,41 +275,51 @@ class LidarDataLogic(ABC):
         files = glob.glob(query)
         return files[0]
 
-    def _extract_by_axis(self, data: Data, axis=0) -> Data:
-        """Filter a data object on a chosen axis, using a relative position .
-        Modifies the original data object so that extracted future filters are faster.
+    def _sort_by_subtile(self, data: Data) -> np.ndarray:
+        """Sort the points of a tile by subtile of width subtile_width_meters, in a single pass.
+
+        Each point is assigned to a cell of a regular xy grid anchored on the tile min corner.
+        Points are then sorted once by cell (x-major, then y), so that each subtile is a contiguous
+        slice of the sorted arrays. Points on the upper boundary of the tile fall in the last cell.
+
+        Args:
+            data (Data): a pyg Data object with pos, x, and y attributes, as returned by load_las.
+            It is sorted in place.
+
+        Returns:
+            np.ndarray: (num_subtiles + 1,) offsets of the non-empty subtiles, ordered by x then y.
+
+        """
+        cell_idx = self._get_subtile_idx(data.pos)
+        order = np.argsort(cell_idx, kind="stable")
+        cell_idx = cell_idx[order]
+        # Reassign one key at a time so that peak memory stays close to a single copy of the tile.
+        data.pos = data.pos[order]
+        data.x = data.x[order]
+        data.y = data.y[order]
+        del order
+
+        bounds = np.flatnonzero(np.diff(cell_idx)) + 1
+        return np.concatenate([[0], bounds, [len(cell_idx)]]).astype(np.int64)
+
+    def _get_subtile_idx(self, pos: np.ndarray) -> np.ndarray:
+        """Compute the flat index of the subtile each point belongs to, in a single vectorized pass.
 
         Args:
-            data (Data): a pyg Data object with pos, x, and y attributes.
-            relative_pos (int): where the data to extract start on chosen axis (typically in range 0-1000)
-            axis (int, optional): 0 for x and 1 for y axis. Defaults to 0.
+            pos (np.ndarray): (N, 3) positions.
 
         Returns:
-            Data: the data that is at most subtile_width_meters above relative_pos on the chosen axis.
+            np.ndarray: (N,) int64 subtile index ix * num_cells_y + iy.
+
         """
-        sub_tile_data = data.clone()
-        pos_axis = sub_tile_data.pos[:, axis]
-        absolute_low = pos_axis.min(0)
-        absolute_high = absolute_low + self.subtile_width_meters
-        mask = (absolute_low <= pos_axis) & (pos_axis <= absolute_high)
-
-        # select
-        sub_tile_data.pos = sub_tile_data.pos[mask]
-        sub_tile_data.x = sub_tile_data.x[mask]
-        sub_tile_data.y = sub_tile_data.y[mask]
-
-        data.pos = data.pos[~mask]
-        data.x = data.x[~mask]
-        data.y = data.y[~mask]
-        return sub_tile_data
-
-    def _extract_by_x(self, data: Data) -> Data:
-        """extract_by_axis applied on first axis x"""
-        return self._extract_by_axis(data, axis=0)
-
-    def _extract_by_y(self, data: Data) -> Data:
-        """extract_by_axis applied on second axis y"""
-        return self._extract_by_axis(data, axis=1)
+        xy = pos[:, :2]
+        low = xy.min(0)
+        num_cells = np.maximum(
+            np.ceil((xy.max(0) - low) / self.subtile_width_meters), 1
+        ).astype(np.int64)
+        ixy = np.floor((xy - low) / self.subtile_width_meters).astype(np.int64)
+        ixy = np.minimum(ixy, num_cells - 1)
+        return ixy[:, 0] * num_cells[1] + ixy[:, 1]
 
     def _save(self, subtile_data: Data, output_subdir_path: str, idx: int) -> None:
         """Save the subtile data object with torch.
@@ -173,6 +333,221 @@ class LidarDataLogic(ABC):
         torch.save(subtile_data, subtile_save_path)
 
 
+SHARDS_DIRNAME = "shards"
+PRESAMPLED_VAL_DIRNAME = "val_presampled"
+SHARD_KEYS = ("pos", "x", "y")
+# Raw little-endian arrays, so that shards can be memory-mapped as-is on any machine.
+SHARD_DTYPES = {"pos": "<f4", "x": "<f4", "y": "<i8"}
+SHARD_OFFSETS_FILENAME = "offsets.npy"
+SHARD_METADATA_FILENAME = "metadata.json"
+
+
+def get_presampling_metadata(subsampler: Subsampler) -> dict:
+    """Describe a subsampler, to check that presampled data match the one of a datamodule."""
+    return {
+        "subsampler": type(subsampler).__name__,
+        "subsample_size": subsampler.subsample_size,
+        "voxel_size": getattr(subsampler, "voxel_size", None),
+        "keep_representative_point": getattr(
+            subsampler, "keep_representative_point", False
+        ),
+    }
+
+
+def save_shard(
+    arrays: Union[Data, Dict[str, np.ndarray]],
+    offsets: np.ndarray,
+    metadata: dict,
+    shard_dir: str,
+) -> None:
+    """Save contiguous subtiles as a shard: one .npy file per key, an offsets index, and metadata.
+
+    Subtile i is made of points offsets[i] to offsets[i+1] of each array.
+
+    Args:
+        arrays (Union[Data, Dict[str, np.ndarray]]): pos, x, and y arrays, in which subtiles are contiguous.
+        offsets (np.ndarray): (num_subtiles + 1,) start of each subtile, and total number of points.
+        metadata (dict): json-serializable information shared by the subtiles.
+        shard_dir (str): output directory.
+
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    for key in SHARD_KEYS:
+        np.save(
+            osp.join(shard_dir, f"{key}.npy"),
+            np.ascontiguousarray(arrays[key], dtype=SHARD_DTYPES[key]),
+        )
+    np.save(
+        osp.join(shard_dir, SHARD_OFFSETS_FILENAME), np.asarray(offsets, dtype=np.int64)
+    )
+    with open(osp.join(shard_dir, SHARD_METADATA_FILENAME), "w") as f:
+        json.dump(metadata, f)
+
+
+def load_shard(
+    shard_dir: str, mmap_mode: Optional[str] = "c"
+) -> Tuple[Dict[str, np.ndarray], np.ndarray, dict]:
+    """Load a shard saved with save_shard.
+
+    Args:
+        shard_dir (str): shard directory.
+        mmap_mode (Optional[str], optional): memory-map mode of arrays (see. np.load). Defaults to
+        "c" (copy-on-write) so that zero-copy views of the file can be turned into writable tensors.
+
+    Returns:
+        Tuple[Dict[str, np.ndarray], np.ndarray, dict]: arrays by key, offsets, and metadata.
+
+    """
+    arrays = {
+        key: np.load(osp.join(shard_dir, f"{key}.npy"), mmap_mode=mmap_mode)
+        for key in SHARD_KEYS
+    }
+    offsets = np.load(osp.join(shard_dir, SHARD_OFFSETS_FILENAME))
+    with open(osp.join(shard_dir, SHARD_METADATA_FILENAME), "r") as f:
+        metadata = json.load(f)
+    return arrays, offsets, metadata
+
+
+def pack_shards(phase_dir: str, points_per_shard: int = 100_000_000) -> None:
+    """Pack the per-file shards of a split into a few large shards, in phase_dir/shards/.
+
+    Files are grouped in order until a shard reaches points_per_shard points. Each shard is written
+    to a temporary directory and renamed once complete. Per-file arrays are then removed, but their
+    directory and completion flag are kept so that a preparation can still be resumed.
+    Shards metadata lists the packed files, so that packing can itself be resumed.
+
+    Args:
+        phase_dir (str): directory of a split (e.g. prepared_data_dir/train).
+        points_per_shard (int, optional): max number of points in a shard, unless a single file
+        is bigger. Defaults to 100_000_000.
+
+    """
+    shards_dir = osp.join(phase_dir, SHARDS_DIRNAME)
+    os.makedirs(shards_dir, exist_ok=True)
+    shard_dirs = sorted(glob.glob(osp.join(shards_dir, "shard_*")))
+    packed_files = set()
+    for shard_dir in shard_dirs:
+        _, _, metadata = load_shard(shard_dir, mmap_mode="r")
+        packed_files.update(metadata["files"])
+
+    groups = []
+    group = []
+    group_num_points = 0
+    file_dirs = sorted(
+        osp.dirname(f)
+        for f in glob.glob(osp.join(phase_dir, "*", SHARD_OFFSETS_FILENAME))
+    )
+    for file_dir in file_dirs:
+        if osp.basename(file_dir) in packed_files:
+            _remove_shard_arrays(file_dir)
+            continue
+        num_points = len(np.load(osp.join(file_dir, "pos.npy"), mmap_mode="r"))
+        if group and group_num_points + num_points > points_per_shard:
+            groups.append(group)
+            group = []
+            group_num_points = 0
+        group.append(file_dir)
+        group_num_points += num_points
+    if group:
+        groups.append(group)
+
+    for shard_idx, group in enumerate(
+        tqdm(groups, desc=f"Shards ({osp.basename(phase_dir)})"), start=len(shard_dirs)
+    ):
+        shard_name = f"shard_{str(shard_idx).zfill(4)}"
+        tmp_dir = osp.join(shards_dir, f"tmp_{shard_name}")
+        _write_shard_from_files(group, tmp_dir)
+        os.rename(tmp_dir, osp.join(shards_dir, shard_name))
+        for file_dir in group:
+            _remove_shard_arrays(file_dir)
+
+
+def _write_shard_from_files(file_dirs: List[str], shard_dir: str) -> None:
+    """Concatenate per-file shards into a single shard, without loading them fully in memory."""
+    if osp.isdir(shard_dir):
+        rmtree(shard_dir)
+    os.makedirs(shard_dir)
+    shards = [load_shard(file_dir, mmap_mode="r") for file_dir in file_dirs]
+
+    for key in SHARD_KEYS:
+        first = shards[0][0][key]
+        shape = (sum(len(arrays[key]) for arrays, _, _ in shards),) + first.shape[1:]
+        out = np.lib.format.open_memmap(
+            osp.join(shard_dir, f"{key}.npy"), mode="w+", dtype=first.dtype, shape=shape
+        )
+        start = 0
+        for arrays, _, _ in shards:
+            out[start : start + len(arrays[key])] = arrays[key]
+            start += len(arrays[key])
+        out.flush()
+        del out
+
+    offsets = [np.zeros(1, dtype=np.int64)]
+    shift = 0
+    for _, file_offsets, _ in shards:
+        offsets.append(file_offsets[1:] + shift)
+        shift += file_offsets[-1]
+    np.save(osp.join(shard_dir, SHARD_OFFSETS_FILENAME), np.concatenate(offsets))
+
+    metadata = {
+        "files": [osp.basename(file_dir) for file_dir in file_dirs],
+        "las_filepaths": [m["las_filepath"] for _, _, m in shards],
+        "num_subtiles_by_file": [len(o) - 1 for _, o, _ in shards],
+        "x_features_names": shards[0][2]["x_features_names"],
+    }
+    if "presampling" in shards[0][2]:
+        metadata["presampling"] = shards[0][2]["presampling"]
+    with open(osp.join(shard_dir, SHARD_METADATA_FILENAME), "w") as f:
+        json.dump(metadata, f)
+
+
+def _remove_shard_arrays(file_dir: str) -> None:
+    """Remove per-file shard arrays once they are packed."""
+    for filename in [f"{key}.npy" for key in SHARD_KEYS] + [
+        SHARD_OFFSETS_FILENAME,
+        SHARD_METADATA_FILENAME,
+    ]:
+        filepath = osp.join(file_dir, filename)
+        if osp.isfile(filepath):
+            os.remove(filepath)
+
+
+def convert_data_dirs_to_shards(
+    prepared_data_dir: str, points_per_shard: int = 100_000_000
+) -> None:
+    """Convert a train/val dataset prepared as `.data` files (one torch.save per subtile) into shards.
+
+    The `.data` files are left untouched and can be removed once shards are created.
+
+    Args:
+        prepared_data_dir (str): directory with train and val subfolders.
+        points_per_shard (int, optional): see pack_shards. Defaults to 100_000_000.
+
+    """
+    for phase in ["train", "val"]:
+        phase_dir = osp.join(prepared_data_dir, phase)
+        file_dirs = sorted(
+            {
+                osp.dirname(f)
+                for f in glob.glob(osp.join(phase_dir, "*", "*.data"))
+            }
+        )
+        for file_dir in tqdm(file_dirs, desc=f"Files ({phase})"):
+            files = sorted(glob.glob(osp.join(file_dir, "*.data")))
+            subtiles = [torch.load(f) for f in files]
+            arrays = {
+                key: np.concatenate([np.asarray(s[key]) for s in subtiles])
+                for key in SHARD_KEYS
+            }
+            offsets = np.cumsum([0] + [len(s.pos) for s in subtiles])
+            metadata = {
+                "las_filepath": subtiles[0].las_filepath,
+                "x_features_names": list(subtiles[0].x_features_names),
+            }
+            save_shard(arrays, offsets, metadata, file_dir)
+        pack_shards(phase_dir, points_per_shard)
+
+
 class FrenchLidarDataLogic(LidarDataLogic):
 
     x_features_names = [
@@ -385,6 +760,47 @@ def _get_data_preparation_parser():
         type=str,
         default="FR",
     )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="data",
+        choices=["data", "shards"],
+        help="Save train/val subtiles as one `.data` file each, or packed into a few large shards by split.",
+    )
+    parser.add_argument(
+        "--points_per_shard",
+        type=int,
+        default=100_000_000,
+        help="Max number of points in a shard (only with shards output format).",
+    )
+    parser.add_argument(
+        "--convert_to_shards",
+        action="store_true",
+        help="Convert `.data` files already in prepared_data_dir into shards, instead of preparing a dataset.",
+    )
+    parser.add_argument(
+        "--presample_val",
+        action="store_true",
+        help="Also save val subtiles already subsampled with a grid sampler, to skip subsampling at each validation epoch.",
+    )
+    parser.add_argument(
+        "--presampling_subsample_size",
+        type=int,
+        default=12500,
+        help="Number of points of presampled val subtiles. Should match datamodule.subsampler.subsample_size.",
+    )
+    parser.add_argument(
+        "--presampling_voxel_size",
+        type=float,
+        default=0.25,
+        help="Voxel size of the grid sampler of val subtiles. Should match datamodule.subsampler.voxel_size.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to prepare files in parallel. Files already prepared are skipped.",
+    )
 
     return parser
 
@@ -413,6 +829,10 @@ def main():
 
     parser = _get_data_preparation_parser()
     args = parser.parse_args()
+    if args.convert_to_shards:
+        convert_data_dirs_to_shards(args.prepared_data_dir, args.points_per_shard)
+        return
+
     if args.origin == "FR":
         data_prepper = FrenchLidarDataLogic(**args.__dict__)
     elif args.origin == "CH":
@@ -0,0 +1,213 @@
+"""Benchmark of subsamplers on real subtiles, prepared via loading.py.
+
+To compare the voxel grid sampler to the former implementation based on one-hot label voting, and the coverage of
+subtiles by approximate FPS to the one of exact FPS, run:
+
+    python -m lidar_multiclass.data.subsampling_benchmark --prepared_data_dir ./prepared/ -h
+
+"""
+
+import argparse
+import copy
+import glob
+import os.path as osp
+import time
+from typing import Dict, List
+
+import torch
+import torch.nn.functional as F
+from torch_geometric.data import Data
+from torch_scatter import scatter_add, scatter_mean
+
+from lidar_multiclass.data.datamodule import LidarMapDataset, LidarShardDataset
+from lidar_multiclass.data.loading import SHARDS_DIRNAME
+from lidar_multiclass.data.transforms import (
+    ApproximateFPSSampler,
+    CustomGridSampler,
+    FPSSampler,
+    RandomSampler,
+    ToTensor,
+)
+from lidar_multiclass.models.modules.knn import knn_grid
+
+
+def voxelize_with_one_hot_labels(data: Data, voxel_size: float) -> Data:
+    """Former voxelization of CustomGridSampler: averages of each voxel with torch_geometric clusters, and labels
+    voted on a one-hot encoding of classification codes. Reference of the benchmark."""
+    import torch_geometric
+
+    num_nodes = data.num_nodes
+    c = torch_geometric.nn.voxel_grid(data.pos, voxel_size, None, None, None)
+    c, perm = torch_geometric.nn.pool.consecutive.consecutive_cluster(c)
+    for key in CustomGridSampler.sampling_keys:
+        if key not in data:
+            continue
+        item = data[key]
+        if key == "y":
+            data[key] = scatter_add(F.one_hot(item.long()), c, dim=0).argmax(dim=-1)
+        elif key == "point_idx":
+            data[key] = item[perm]
+        elif item.size(0) == num_nodes:
+            data[key] = scatter_mean(item, c, dim=0)
+    return data
+
+
+def load_subtiles(prepared_data_dir: str, phase: str, num_subtiles: int) -> List[Data]:
+    """Load the first subtiles of a phase, from shards or from individual `.data` files."""
+    phase_dir = osp.join(prepared_data_dir, phase)
+    shard_dirs = sorted(glob.glob(osp.join(phase_dir, SHARDS_DIRNAME, "shard_*")))
+    if shard_dirs:
+        dataset = LidarShardDataset(shard_dirs)
+    else:
+        files = sorted(glob.glob(osp.join(phase_dir, "**", "*.data"), recursive=True))
+        dataset = LidarMapDataset(files, loading_function=torch.load)
+    subtiles = []
+    for idx in range(min(num_subtiles, len(dataset))):
+        data = ToTensor()(dataset[idx])
+        data.point_idx = torch.arange(data.num_nodes)
+        subtiles.append(data)
+    return subtiles
+
+
+def _voxel_keys(data: Data, point_idx: torch.Tensor, voxel_size: float) -> torch.Tensor:
+    """Key of the voxel of points of a subtile, to match voxels across samplers."""
+    cells = ((data.pos - data.pos.min(0)[0]) / voxel_size).floor().long()
+    num_cells = cells.max(0)[0] + 1
+    cells = cells[point_idx]
+    return (cells[:, 0] * num_cells[1] + cells[:, 1]) * num_cells[2] + cells[:, 2]
+
+
+def benchmark_grid_sampling(
+    subtiles: List[Data], voxel_size: float, repeats: int
+) -> Dict[str, Dict[str, float]]:
+    """Time the voxelization of subtiles, and compare labels and positions of voxels to the reference.
+
+    Returns:
+        Dict[str, Dict[str, float]]: by sampler, milliseconds per subtile, number of voxels per subtile, agreement
+        of voxel labels with the reference, and max difference of voxel positions to the reference.
+
+    """
+    samplers = {
+        "one_hot (reference)": lambda data: voxelize_with_one_hot_labels(data, voxel_size),
+        "grid": CustomGridSampler(voxel_size=voxel_size).voxelize,
+        "grid, representative point": CustomGridSampler(
+            voxel_size=voxel_size, keep_representative_point=True
+        ).voxelize,
+    }
+    metrics = {}
+    reference = []
+    for name, sampler in samplers.items():
+        seconds = 0.0
+        num_voxels = 0
+        agreement = 0
+        max_pos_difference = 0.0
+        for subtile_idx, data in enumerate(subtiles):
+            ts = time.perf_counter()
+            for _ in range(repeats):
+                voxels = sampler(copy.copy(data))
+            seconds += (time.perf_counter() - ts) / repeats
+            num_voxels += voxels.num_nodes
+            if len(reference) <= subtile_idx:
+                reference.append(voxels)
+
+            # Voxels are matched through the voxel of the point that identifies them.
+            order = torch.argsort(_voxel_keys(data, voxels.point_idx, voxel_size))
+            reference_voxels = reference[subtile_idx]
+            reference_order = torch.argsort(
+                _voxel_keys(data, reference_voxels.point_idx, voxel_size)
+            )
+            agreement += (voxels.y[order] == reference_voxels.y[reference_order]).sum().item()
+            pos_difference = voxels.pos[order] - reference_voxels.pos[reference_order]
+            max_pos_difference = max(max_pos_difference, pos_difference.abs().max().item())
+        metrics[name] = {
+            "ms_per_subtile": seconds * 1000 / len(subtiles),
+            "voxels_per_subtile": num_voxels / len(subtiles),
+            "labels_agreement": agreement / num_voxels,
+            "max_pos_difference": max_pos_difference,
+        }
+    return metrics
+
+
+def get_coverage_distances(pos: torch.Tensor, sampled_pos: torch.Tensor) -> torch.Tensor:
+    """Distance from each point of a subtile to the closest sampled point."""
+    origin = pos.min(0)[0]
+    _, dist2 = knn_grid(
+        (sampled_pos - origin).unsqueeze(0), (pos - origin).unsqueeze(0), 1
+    )
+    return dist2.flatten().sqrt()
+
+
+def benchmark_fps(
+    subtiles: List[Data], subsample_size: int, repeats: int
+) -> Dict[str, Dict[str, float]]:
+    """Time subsamplers, and measure how well sampled points cover subtiles, compared to exact FPS.
+
+    FPS minimizes the largest distance from a point to the closest sampled point (max_distance). The mean and
+    99th percentile of those distances tell how evenly the rest of the subtile is covered.
+
+    Returns:
+        Dict[str, Dict[str, float]]: by sampler, milliseconds per subtile, and mean, 99th percentile and max
+        distance from a point to the closest sampled point, averaged over subtiles.
+
+    """
+    samplers = {
+        "exact FPS (reference)": FPSSampler(subsample_size),
+        "approximate FPS": ApproximateFPSSampler(subsample_size),
+        "random": RandomSampler(subsample_size),
+    }
+    metrics = {}
+    for name, sampler in samplers.items():
+        sampler_metrics = {
+            "ms_per_subtile": 0.0,
+            "mean_distance": 0.0,
+            "p99_distance": 0.0,
+            "max_distance": 0.0,
+        }
+        for data in subtiles:
+            ts = time.perf_counter()
+            for _ in range(repeats):
+                sampled = sampler(copy.copy(data))
+            sampler_metrics["ms_per_subtile"] += (time.perf_counter() - ts) * 1000 / repeats
+            distances = get_coverage_distances(data.pos, sampled.pos)
+            sampler_metrics["mean_distance"] += distances.mean().item()
+            sampler_metrics["p99_distance"] += torch.quantile(distances, 0.99).item()
+            sampler_metrics["max_distance"] += distances.max().item()
+        metrics[name] = {
+            key: value / len(subtiles) for key, value in sampler_metrics.items()
+        }
+    return metrics
+
+
+def main():
+    """Benchmark subsamplers on subtiles of a prepared dataset, on CPU."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--prepared_data_dir", required=True, type=str)
+    parser.add_argument("--phase", default="val", type=str)
+    parser.add_argument("--num_subtiles", default=20, type=int)
+    parser.add_argument("--voxel_size", default=0.25, type=float)
+    parser.add_argument("--subsample_size", default=12500, type=int)
+    parser.add_argument("--repeats", default=3, type=int)
+    args = parser.parse_args()
+
+    subtiles = load_subtiles(args.prepared_data_dir, args.phase, args.num_subtiles)
+    metrics = benchmark_grid_sampling(subtiles, args.voxel_size, args.repeats)
+    for name, sampler_metrics in metrics.items():
+        print(
+            f"{name}: {sampler_metrics['ms_per_subtile']:.1f} ms per subtile | "
+            f"{sampler_metrics['voxels_per_subtile']:.0f} voxels per subtile | "
+            f"labels agreement {sampler_metrics['labels_agreement']:.2%} | "
+            f"max position difference {sampler_metrics['max_pos_difference']:.2e}"
+        )
+    metrics = benchmark_fps(subtiles, args.subsample_size, args.repeats)
+    for name, sampler_metrics in metrics.items():
+        print(
+            f"{name}: {sampler_metrics['ms_per_subtile']:.1f} ms per subtile | "
+            f"distance to the closest sampled point: "
+            f"mean {sampler_metrics['mean_distance']:.3f} m, "
+            f"99th percentile {sampler_metrics['p99_distance']:.3f} m, "
+            f"max {sampler_metrics['max_distance']:.3f} m"
+        )
+
+
+if __name__ == "__main__":
+    main()
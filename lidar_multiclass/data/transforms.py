@@ -3,14 +3,11 @@ from enum import Enum
 from numbers import Number
 from typing import Callable, Dict, List, Tuple
 
-import numpy as np
 import torch
-import torch_geometric
 from torch_geometric.data import Batch, Data
 from torch_geometric.transforms import BaseTransform
 from torch_geometric.nn.pool import fps
-from torch_scatter import scatter_add, scatter_mean
-import torch.nn.functional as F
+from torch_scatter import scatter_add, scatter_max, scatter_mean, scatter_min
 from lidar_multiclass.utils import utils
 
 log = utils.get_logger(__name__)
@@ -60,7 +57,7 @@ class EmptySubtileFilter(BaseTransform):
 class ToTensor(BaseTransform):
     """Turn np.arrays specified by their keys into Tensor."""
 
-    def __init__(self, keys=["pos", "x", "y"]):
+    def __init__(self, keys=["pos", "x", "y", "point_idx"]):
         self.keys = keys
 
     def __call__(self, data: Data):
@@ -70,11 +67,19 @@ class ToTensor(BaseTransform):
         return data
 
 
-class MakeCopyOfPosAndY(BaseTransform):
-    """Make a copy of the full cloud's positions and labels, for inference interpolation."""
+class KeepFullResolutionIdxAndY(BaseTransform):
+    """Keep track of the full cloud's points and labels, for inference interpolation.
+
+    Points are identified by their int64 index in the tile they were extracted from (point_idx), instead of by
+    a copy of their positions. point_idx is set to the index of points in the subtile when absent, and is then
+    carried along by subsamplers. The full resolution indices and labels are kept as point_idx_copy and y_copy.
+
+    """
 
     def __call__(self, data: Data):
-        data["pos_copy"] = data["pos"].clone()
+        if "point_idx" not in data:
+            data["point_idx"] = torch.arange(data.num_nodes)
+        data["point_idx_copy"] = data["point_idx"]
         data["y_copy"] = data["y"].clone()
         return data
 
@@ -88,7 +93,8 @@ class Subsampler(BaseTransform):
 
     """
 
-    sampling_keys: Tuple[str] = ("x", "pos", "y")
+    # Keys absent from the data are skipped.
+    sampling_keys: Tuple[str] = ("x", "pos", "y", "point_idx")
 
     def _call_(self, data: Data):
         raise NotImplementedError("Use a non-abstract subsampler class instead.")
@@ -111,7 +117,8 @@ class RandomSampler(Subsampler):
         )[: self.subsample_size]
 
         for key in self.sampling_keys:
-            data[key] = data[key][choice]
+            if key in data:
+                data[key] = data[key][choice]
 
         return data
 
@@ -121,6 +128,7 @@ class FPSSampler(Subsampler):
     Samples a fixed number of points from a point cloud, using Fartest Point Sampling.
 
     In our experiments, FPS is slower by an order of magnitude than Random/Grid sampling, and yields worst results.
+    See ApproximateFPSSampler for a faster approximation.
 
     See https://pytorch-geometric.readthedocs.io/en/latest/modules/nn.html?highlight=fps#torch_geometric.nn.pool.fps
 
@@ -141,22 +149,118 @@ class FPSSampler(Subsampler):
         choice = fps(data.pos, ratio=ratio, random_start=False)
         choice = choice[: self.subsample_size]
         for key in self.sampling_keys:
-            data[key] = data[key][choice]
+            if key in data:
+                data[key] = data[key][choice]
         return data
 
 
+class ApproximateFPSSampler(Subsampler):
+    """Samples a fixed number of well-spread points from a point cloud, in near-linear time, as an approximation of
+    Farthest Point Sampling.
+
+    Each point gets a random priority. Within each voxel of a grid, the point of lowest priority represents
+    the voxel. With voxels that are twice as large from a level to the next, representatives of a level are
+    also representatives of the finer levels. Points are then taken coarsest level first, which spreads
+    them like FPS does: a point is only taken once all the coarser voxels have a representative.
+
+    """
+
+    def __init__(self, subsample_size: int = 12500, max_num_levels: int = 16):
+        """Initialization method.
+
+        Args:
+            subsample_size (int): number of sampled points.
+            max_num_levels (int): maximal number of grid levels.
+
+        """
+        self.subsample_size = subsample_size
+        self.max_num_levels = max_num_levels
+        self.rs = RandomSampler(subsample_size=subsample_size)
+
+    def __call__(self, data: Data):
+        num_nodes = data.num_nodes
+        # Random sampling if we are short in points
+        if num_nodes < self.subsample_size:
+            return self.rs(data)
+
+        choice = self.get_choice(data.pos)
+        for key in self.sampling_keys:
+            if key in data:
+                data[key] = data[key][choice]
+        return data
+
+    def get_choice(self, pos: torch.Tensor) -> torch.Tensor:
+        """Get the indices of subsample_size well-spread points among (N, 3) positions."""
+        num_nodes = pos.size(0)
+        pos = pos - pos.min(0)[0]
+        priority_order = torch.randperm(num_nodes, device=pos.device)
+        rank = torch.empty_like(priority_order)
+        rank[priority_order] = torch.arange(num_nodes, device=pos.device)
+
+        # Finest level: at least as many voxels as sampled points. The number of voxels is assumed to scale
+        # like the one of a surface, as for the ground seen from above.
+        xy_area = pos[:, :2].max(0)[0].prod().item()
+        voxel_size = math.sqrt(max(xy_area, 1e-6) / self.subsample_size)
+        representatives = self._get_representatives(pos, priority_order, voxel_size)
+        for _ in range(self.max_num_levels):
+            if len(representatives) >= self.subsample_size:
+                break
+            voxel_size /= 1.1 * math.sqrt(self.subsample_size / len(representatives))
+            representatives = self._get_representatives(pos, priority_order, voxel_size)
+
+        # Coarser levels: representatives of a voxel are among the ones of its sub-voxels.
+        level = torch.full_like(priority_order, self.max_num_levels + 1)
+        for coarseness in range(self.max_num_levels, -1, -1):
+            level[representatives] = coarseness
+            if len(representatives) == 1:
+                break
+            voxel_size *= 2
+            subset_order = representatives[torch.argsort(rank[representatives])]
+            representatives = self._get_representatives(
+                pos[subset_order], torch.arange(len(subset_order)), voxel_size
+            )
+            representatives = subset_order[representatives]
+
+        # Coarsest level first, then lowest priority.
+        key = level * num_nodes + rank
+        return torch.topk(key, self.subsample_size, largest=False, sorted=False)[1]
+
+    @staticmethod
+    def _get_representatives(
+        pos: torch.Tensor, priority_order: torch.Tensor, voxel_size: float
+    ) -> torch.Tensor:
+        """Get the index of the point of lowest priority of each voxel, with points in priority_order."""
+        cells = (pos[priority_order] / voxel_size).floor().long()
+        num_cells = cells.max(0)[0] + 1
+        keys = (cells[:, 0] * num_cells[1] + cells[:, 1]) * num_cells[2] + cells[:, 2]
+        sorted_keys, order = torch.sort(keys, stable=True)
+        is_first = torch.ones_like(sorted_keys, dtype=torch.bool)
+        is_first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        return priority_order[order[is_first]]
+
+
 class CustomGridSampler(Subsampler):
     """Samples a point cloud, using a voxel grid.
 
+    Points are grouped by voxel with a single sort of integer voxel keys. Each voxel is then either averaged,
+    with the most frequent label of its points, or represented by one of its points, with its own features and
+    label (keep_representative_point=True).
+
     A final random sampling is then needed to have a fixed number of points.
     See https://pytorch-geometric.readthedocs.io/en/latest/_modules/torch_geometric/transforms/grid_sampling.html#GridSampling
 
     """
 
-    def __init__(self, subsample_size: int = 12500, voxel_size: Number = 0.25):
+    def __init__(
+        self,
+        subsample_size: int = 12500,
+        voxel_size: Number = 0.25,
+        keep_representative_point: bool = False,
+    ):
         self.subsample_size = subsample_size
         self.rs = RandomSampler(subsample_size=subsample_size)
         self.voxel_size = voxel_size
+        self.keep_representative_point = keep_representative_point
 
     def __call__(self, data: Data) -> Data:
         num_nodes = data.num_nodes
@@ -165,26 +269,75 @@ class CustomGridSampler(Subsampler):
         if num_nodes < self.subsample_size:
             return self.rs(data)
 
-        batch = data.get("batch", None)
+        data = self.voxelize(data)
+        # Up or downsample to get to subsample_size
+        data = self.rs(data)
+        return data
 
-        c = torch_geometric.nn.voxel_grid(data.pos, self.voxel_size, batch, None, None)
-        c, perm = torch_geometric.nn.pool.consecutive.consecutive_cluster(c)
+    def voxelize(self, data: Data) -> Data:
+        """Reduce a point cloud to one point per voxel."""
+        num_nodes = data.num_nodes
+        voxel, first_point, num_points = self._get_voxels(data)
 
         for key in self.sampling_keys:
+            if key not in data:
+                continue
             item = data[key]
             if torch.is_tensor(item) and item.size(0) == num_nodes:
-                if key == "y":
-                    item = F.one_hot(item)
-                    item = scatter_add(item, c, dim=0)
-                    data[key] = item.argmax(dim=-1)
-                elif key == "batch":
-                    data[key] = item[perm]
+                if self.keep_representative_point or key in ["batch", "point_idx"]:
+                    # A voxel is identified by one of its points.
+                    data[key] = item[first_point]
+                elif key == "y":
+                    data[key] = self._get_most_frequent_label(item, voxel, len(num_points))
                 else:
-                    data[key] = scatter_mean(item, c, dim=0)
-        # Up or downsample to get to subsample_size
-        data = self.rs(data)
+                    sums = item.new_zeros((len(num_points),) + item.shape[1:])
+                    sums.index_add_(0, voxel, item)
+                    data[key] = sums / num_points.view(-1, *([1] * (item.dim() - 1)))
         return data
 
+    def _get_voxels(self, data: Data) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Get the voxel of each point, and the first point and the number of points of each voxel.
+
+        Voxels are numbered by increasing key, with keys from the integer coordinates of voxels (and the sample
+        of points, if data is a batch).
+
+        """
+        cells = ((data.pos - data.pos.min(0)[0]) / self.voxel_size).floor().long()
+        num_cells = cells.max(0)[0] + 1
+        keys = (cells[:, 0] * num_cells[1] + cells[:, 1]) * num_cells[2] + cells[:, 2]
+        batch = data.get("batch", None)
+        if batch is not None:
+            keys += batch * num_cells.prod()
+
+        sorted_keys, order = torch.sort(keys, stable=True)
+        _, sorted_voxel, num_points = torch.unique_consecutive(
+            sorted_keys, return_inverse=True, return_counts=True
+        )
+        voxel = torch.empty_like(sorted_voxel)
+        voxel[order] = sorted_voxel
+        first_point = order[torch.cumsum(num_points, 0) - num_points]
+        return voxel, first_point, num_points
+
+    def _get_most_frequent_label(
+        self, y: torch.Tensor, voxel: torch.Tensor, num_voxels: int
+    ) -> torch.Tensor:
+        """Get the most frequent label of each voxel, or the smallest one in case of a tie.
+
+        (voxel, label) pairs are counted by sorting them, which avoids a one-hot encoding of labels, as wide
+        as the largest classification code.
+
+        """
+        num_labels = int(y.max()) + 1
+        pairs, pair_counts = torch.unique(voxel * num_labels + y.long(), return_counts=True)
+        pair_voxel = pairs // num_labels
+        pair_label = pairs % num_labels
+        # Order pairs by voxel, count, and decreasing label: the last pair of a voxel has its most frequent label.
+        rank = (pair_voxel * (len(y) + 1) + pair_counts) * num_labels + (
+            num_labels - 1 - pair_label
+        )
+        last_pair = torch.cumsum(torch.bincount(pair_voxel, minlength=num_voxels), 0) - 1
+        return pair_label[torch.argsort(rank)[last_pair]]
+
 
 class MakeCopyOfSampledPos(BaseTransform):
     """Make a copy of the unormalized positions of subsampled points."""
@@ -244,6 +397,96 @@ class NormalizePos(BaseTransform):
         return "{}()".format(self.__class__.__name__)
 
 
+def reduce_segments(values: torch.Tensor, batch: Batch, reduce: str) -> torch.Tensor:
+    """Reduce (N, ...) values of the points of a collated Batch over each sample, into (B, ...) values.
+
+    Args:
+        reduce (str): "sum", "mean", "max" or "min".
+
+    """
+    if batch.sample_size:
+        dense = values.view(batch.batch_size, batch.sample_size, *values.shape[1:])
+        reductions = {"sum": torch.sum, "mean": torch.mean, "max": torch.amax, "min": torch.amin}
+        return reductions[reduce](dense, dim=1)
+    scatter = {
+        "sum": scatter_add,
+        "mean": scatter_mean,
+        "max": lambda *args, **kwargs: scatter_max(*args, **kwargs)[0],
+        "min": lambda *args, **kwargs: scatter_min(*args, **kwargs)[0],
+    }[reduce]
+    return scatter(values, batch.batch_x, dim=0, dim_size=batch.batch_size)
+
+
+def expand_segments(values: torch.Tensor, batch: Batch) -> torch.Tensor:
+    """Expand (B, ...) values of the samples of a collated Batch to (N, ...) values of their points."""
+    if batch.sample_size:
+        dense = values.unsqueeze(1).expand(-1, batch.sample_size, *values.shape[1:])
+        return dense.reshape(-1, *values.shape[1:])
+    return values[batch.batch_x]
+
+
+class BatchCenter(BaseTransform):
+    """Center the positions of each sample of a collated Batch, like Center does for a single sample."""
+
+    def __call__(self, batch: Batch):
+        batch.pos = batch.pos - expand_segments(reduce_segments(batch.pos, batch, "mean"), batch)
+        return batch
+
+
+class BatchRandomFlip(BaseTransform):
+    """Flip the positions of each sample of a collated Batch along an axis with probability p, like RandomFlip."""
+
+    def __init__(self, axis: int, p: float = 0.5):
+        self.axis = axis
+        self.p = p
+
+    def __call__(self, batch: Batch):
+        flip = torch.rand(batch.batch_size, device=batch.pos.device) < self.p
+        sign = expand_segments(1.0 - 2.0 * flip.to(batch.pos.dtype), batch)
+        batch.pos[:, self.axis] = batch.pos[:, self.axis] * sign
+        return batch
+
+
+class BatchNormalizePos(BaseTransform):
+    """Normalize the positions of each sample of a collated Batch, like NormalizePos."""
+
+    def __call__(self, batch: Batch):
+        xy_amplitude = batch.pos[:, :2].abs().amax(dim=1)
+        xy_positive_amplitude = reduce_segments(xy_amplitude, batch, "max")
+        xy_scale = expand_segments((1 / xy_positive_amplitude) * 0.999999, batch)
+        z_min = expand_segments(reduce_segments(batch.pos[:, 2], batch, "min"), batch)
+        batch.pos[:, :2] = batch.pos[:, :2] * xy_scale.unsqueeze(-1)
+        batch.pos[:, 2] = (batch.pos[:, 2] - z_min) * xy_scale
+        return batch
+
+
+class BatchStandardizeFeatures(StandardizeFeatures):
+    """Standardize the features of each sample of a collated Batch, like StandardizeFeatures."""
+
+    def __call__(self, batch: Batch):
+        # Feature names are the same for all samples.
+        x_features_names = batch.x_features_names[0]
+        idx = x_features_names.index("intensity")
+        batch.x[:, idx] = self._log(batch.x[:, idx], shift=1)
+        batch.x[:, idx] = self._standardize_segments(batch.x[:, idx], batch)
+        idx = x_features_names.index("rgb_avg")
+        batch.x[:, idx] = self._standardize_segments(batch.x[:, idx], batch)
+        return batch
+
+    def _standardize_segments(
+        self, channel_data: torch.Tensor, batch: Batch, clamp_sigma: int = 3
+    ):
+        """Sample-wise standardization y* = (y-y_mean)/y_std, with the unbiased std of each sample."""
+        num_points = reduce_segments(torch.ones_like(channel_data), batch, "sum")
+        mean = reduce_segments(channel_data, batch, "mean")
+        centered = channel_data - expand_segments(mean, batch)
+        variance = reduce_segments(centered**2, batch, "sum") / (num_points - 1)
+        std = expand_segments(variance.sqrt() + 10**-6, batch)
+        standard = centered / std
+        clamp = clamp_sigma * std
+        return torch.maximum(torch.minimum(standard, clamp), -clamp)
+
+
 class TargetTransform(BaseTransform):
     """
     Make target vector based on input classification dictionnary.
@@ -259,6 +502,9 @@ class TargetTransform(BaseTransform):
 
     """
 
+    # Classification codes are stored on a single byte in LAS format.
+    num_class_codes = 256
+
     def __init__(
         self,
         classification_preprocessing_dict: Dict[int, int],
@@ -267,67 +513,103 @@ class TargetTransform(BaseTransform):
 
         self._set_preprocessing_mapper(classification_preprocessing_dict)
         self._set_mapper(classification_dict)
+        # Both mappings are composed into a single lookup table, applied with a single indexing.
+        self.lookup_table = self.mapper[self.preprocessing_mapper]
 
     def __call__(self, data: Data):
         data.y = self.transform(data.y)
-        data.y_copy = self.transform(data.y_copy)
+        # Full resolution targets are only kept at test time (see KeepFullResolutionIdxAndY).
+        if "y_copy" in data:
+            data.y_copy = self.transform(data.y_copy)
         return data
 
     def transform(self, y):
-        y = self.preprocessing_mapper(y)
-        y = self.mapper(y)
-        return torch.LongTensor(y)
+        y = torch.as_tensor(y, dtype=torch.long)
+        targets = self.lookup_table[y]
+        unknown = targets < 0
+        if unknown.any():
+            raise KeyError(
+                f"Classification codes {torch.unique(y[unknown]).tolist()} are not in classification_dict "
+                "after preprocessing."
+            )
+        return targets
 
     def _set_preprocessing_mapper(self, classification_preprocessing_dict):
-        """Set mapper from source classification code to another code."""
-        d = {key: value for key, value in classification_preprocessing_dict.items()}
-        self.preprocessing_mapper = np.vectorize(
-            lambda class_code: d.get(class_code, class_code)
-        )
+        """Set lookup table from source classification code to another code."""
+        self.preprocessing_mapper = torch.arange(self.num_class_codes)
+        for source_code, target_code in classification_preprocessing_dict.items():
+            self.preprocessing_mapper[source_code] = target_code
 
     def _set_mapper(self, classification_dict):
-        """Set mapper from source classification code to consecutive integers."""
-        d = {
-            class_code: class_index
-            for class_index, class_code in enumerate(classification_dict.keys())
-        }
-        self.mapper = np.vectorize(lambda class_code: d.get(class_code))
-
-
-def collate_fn(data_list: List[Data]) -> Batch:
+        """Set lookup table from source classification code to consecutive integers.
+        Codes absent from classification_dict are mapped to -1."""
+        self.mapper = torch.full((self.num_class_codes,), -1, dtype=torch.long)
+        for class_index, class_code in enumerate(classification_dict.keys()):
+            self.mapper[class_code] = class_index
+
+
+# Per-point attributes, which are concatenated in batches.
+POINT_KEYS = (
+    "pos",
+    "x",
+    "y",
+    "point_idx",
+    "point_idx_copy",
+    "pos_copy_subsampled",
+    "y_copy",
+)
+
+
+def collate_fn(
+    data_list: List[Data],
+    pin_memory: bool = False,
+) -> Batch:
     """
     Batch Data objects from a list, to be used in DataLoader. Modified from:
     https://pytorch-geometric.readthedocs.io/en/latest/_modules/torch_geometric/loader/dense_data_loader.html?highlight=collate_fn
 
+    Per-point attributes of samples are copied once, into tensors of the batch allocated up front. Other
+    attributes (e.g. las_filepath) are kept as lists. Absent attributes are skipped.
+
+    Args:
+        data_list (List[Data]): samples, of which None values are filtered out.
+        pin_memory (bool): whether to allocate per-point tensors in pinned memory, for faster copies to GPU.
+        Pinned memory does not survive transfers from dataloader workers: only use it without workers.
+
     """
     batch = Batch()
-    data_list = list(filter(lambda x: x is not None, data_list))
+    data_list = [data for data in data_list if data is not None]
+    # Batches may be entirely filtered out when an iterable dataset is read by multiple workers.
+    if not data_list:
+        return None
 
-    # 1: add everything as list of non-Tensor object to facilitate adding new attributes.
     for key in data_list[0].keys:
-        batch[key] = [data[key] for data in data_list]
-
-    # 2: define relevant Tensor in long PyG format.
-    keys_to_long_format = ["pos", "x", "y", "pos_copy", "pos_copy_subsampled", "y_copy"]
-    for key in keys_to_long_format:
-        batch[key] = torch.cat([data[key] for data in data_list])
-
-    # 3. Create a batch index
-    batch.batch_x = torch.from_numpy(
-        np.concatenate(
-            [
-                np.full(shape=len(data["y"]), fill_value=i)
-                for i, data in enumerate(data_list)
-            ]
+        items = [data[key] for data in data_list]
+        if key not in POINT_KEYS:
+            batch[key] = items
+            continue
+        out = torch.empty(
+            (sum(len(item) for item in items),) + items[0].shape[1:],
+            dtype=items[0].dtype,
+            pin_memory=pin_memory,
         )
-    )
-    batch.batch_y = torch.from_numpy(
-        np.concatenate(
-            [
-                np.full(shape=len(data["pos_copy"]), fill_value=i)
-                for i, data in enumerate(data_list)
-            ]
+        batch[key] = torch.cat(items, out=out)
+
+    # Batch indices of points, and of full resolution points.
+    sample_sizes = [len(data["pos"]) for data in data_list]
+    batch.batch_x = _get_batch_idx(sample_sizes)
+    if "point_idx_copy" in batch:
+        batch.batch_y = _get_batch_idx(
+            [len(data["point_idx_copy"]) for data in data_list]
         )
-    )
     batch.batch_size = len(data_list)
+    # Number of points of each sample if it is the same for all, e.g. after subsampling, else 0.
+    batch.sample_size = sample_sizes[0] if len(set(sample_sizes)) == 1 else 0
     return batch
+
+
+def _get_batch_idx(sizes: List[int]) -> torch.Tensor:
+    """Get the index of the sample of each point, from the number of points of each sample."""
+    if len(set(sizes)) == 1:
+        return torch.arange(len(sizes)).repeat_interleave(sizes[0])
+    return torch.arange(len(sizes)).repeat_interleave(torch.tensor(sizes))
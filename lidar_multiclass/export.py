@@ -0,0 +1,434 @@
+"""Export of a trained neural network to a standalone TorchScript or ONNX artifact, and inference with it.
+
+Export a checkpoint with `python run.py task.task_name=export` and the same configuration as for predictions,
+with `predict.exported_model` set to the path of the artifact to create. When `predict.exported_model` is set,
+predictions then use the artifact instead of the checkpoint: neither the Lightning module nor its neural network
+classes are instantiated, and batches go through a single traced graph.
+
+The TorchScript artifact has a fixed (B, N, d_in) input signature, with B the datamodule batch size and N the
+subsample size. Smaller batches are padded. With `predict.quantize_int8=true`, the network is quantized to int8
+beforehand, for CPU inference (see lidar_multiclass.models.quantization).
+
+If `predict.exported_model` ends with ".onnx", the network is exported to ONNX instead, and run with onnxruntime
+(optional dependencies: onnx and onnxruntime). Neighbor search is not part of the ONNX graph: neighbors are
+searched beforehand with the KNN backend of the network, and given as inputs along with the random order of points.
+After export, predicted classes are compared to the ones of the PyTorch network on a sample of predict.src_las.
+
+"""
+
+import contextlib
+import itertools
+import json
+import os
+from typing import Dict, List
+
+import hydra
+import torch
+from omegaconf import DictConfig, OmegaConf
+from pytorch_lightning import LightningModule
+from torch import nn
+
+from lidar_multiclass.models.modules.knn import get_knn_function
+from lidar_multiclass.models.modules.randla_net import search_neighbors
+from lidar_multiclass.utils import utils
+
+log = utils.get_logger(__name__)
+
+EXPORT_METADATA_FILENAME = "metadata.json"
+# KNN backend used in exported networks: the other ones are either not torch operators or depend on the data.
+EXPORT_KNN_BACKEND = "brute_force"
+ONNX_METADATA_KEY = "lidar_multiclass"
+ONNX_OPSET_VERSION = 13
+
+
+class DenseNeuralNet(nn.Module):
+    """Wraps the dense forward pass of a neural network, to be traced."""
+
+    def __init__(self, neural_net: nn.Module):
+        super().__init__()
+        self.neural_net = neural_net
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        return self.neural_net.forward_dense(input)
+
+
+class NeighborsInputNeuralNet(nn.Module):
+    """Wraps the forward pass of a RandLANet with points order and neighbors as inputs, to be exported to ONNX."""
+
+    def __init__(self, neural_net: nn.Module):
+        super().__init__()
+        self.neural_net = neural_net
+        self.num_levels = len(neural_net.encoder)
+
+    def forward(self, input: torch.Tensor, permutation: torch.Tensor, *neighbors):
+        L = self.num_levels
+        knn_outputs = list(zip(neighbors[:L], neighbors[L : 2 * L]))
+        upsampling_neighbors = list(neighbors[2 * L :])
+        return self.neural_net.forward_with_neighbors(
+            input, permutation, knn_outputs, upsampling_neighbors
+        )
+
+    def get_input_names(self) -> List[str]:
+        L = range(self.num_levels)
+        return (
+            ["input", "permutation"]
+            + [f"neighbors_{level}" for level in L]
+            + [f"squared_distances_{level}" for level in L]
+            + [f"upsampling_neighbors_{level}" for level in L]
+        )
+
+
+def get_neighbors_inputs(input: torch.Tensor, metadata: dict) -> Dict[str, torch.Tensor]:
+    """Get the random order of points and the neighbors that an ONNX RandLANet takes as inputs.
+
+    Args:
+        input (torch.Tensor): (B, N, d_in) dense input.
+        metadata (dict): export metadata, with num_neighbors, decimation, num_levels and knn_backend.
+
+    """
+    permutation = torch.randperm(input.size(1))
+    knn_outputs, upsampling_neighbors = search_neighbors(
+        input[:, permutation, :3],
+        get_knn_function(metadata["knn_backend"]),
+        metadata["num_neighbors"],
+        metadata["decimation"],
+        metadata["num_levels"],
+    )
+    inputs = {"input": input, "permutation": permutation}
+    for level, (idx, dist) in enumerate(knn_outputs):
+        inputs[f"neighbors_{level}"] = idx.long()
+        inputs[f"squared_distances_{level}"] = dist.float()
+    for level, neighbors in enumerate(upsampling_neighbors):
+        inputs[f"upsampling_neighbors_{level}"] = neighbors.long()
+    return inputs
+
+
+def export(config: DictConfig) -> str:
+    """Trace the neural network of a checkpoint into a standalone TorchScript artifact, or an ONNX one.
+
+    Args:
+        config (DictConfig): Configuration composed by Hydra. Uses predict.resume_from_checkpoint,
+        predict.exported_model, predict.linear_mlp, datamodule.batch_size and datamodule.subsampler.subsample_size.
+
+    Returns:
+        str: path to the exported artifact.
+
+    """
+    exported_model = config.predict.get("exported_model")
+    assert exported_model, "Set predict.exported_model to the path of the artifact to create."
+    assert os.path.exists(config.predict.resume_from_checkpoint)
+
+    model: LightningModule = hydra.utils.instantiate(config.model)
+    model = model.load_from_checkpoint(config.predict.resume_from_checkpoint)
+    model.eval()
+    os.makedirs(os.path.dirname(os.path.abspath(exported_model)), exist_ok=True)
+    if exported_model.endswith(".onnx"):
+        return export_onnx(model, exported_model, config)
+
+    neural_net = model.model
+    if hasattr(neural_net, "set_knn_backend"):
+        neural_net.set_knn_backend(EXPORT_KNN_BACKEND)
+    if hasattr(neural_net, "set_linear_mlp"):
+        neural_net.set_linear_mlp(config.predict.get("linear_mlp", False))
+
+    metadata = {
+        "neural_net_class_name": model.hparams.neural_net_class_name,
+        "batch_size": config.datamodule.batch_size,
+        "num_points": config.datamodule.subsampler.subsample_size,
+        "d_in": model.hparams.d_in,
+    }
+    engine = contextlib.nullcontext()
+    if config.predict.get("quantize_int8", False):
+        from lidar_multiclass.models.quantization import quantized_engine
+
+        # int8 operators run with the quantized engine, from calibration to tracing. It is restored afterwards.
+        engine = quantized_engine()
+    example = torch.rand(metadata["batch_size"], metadata["num_points"], metadata["d_in"])
+    with engine, torch.no_grad():
+        if config.predict.get("quantize_int8", False):
+            neural_net = quantize_on_prepared_data(neural_net, config)
+            metadata["quantization"] = "int8"
+        # Random decimation in RandLANet makes outputs differ from one run to the other.
+        traced = torch.jit.trace(
+            DenseNeuralNet(neural_net).eval(), example, check_trace=False
+        )
+    torch.jit.save(
+        traced,
+        exported_model,
+        _extra_files={EXPORT_METADATA_FILENAME: json.dumps(metadata)},
+    )
+    log.info(f"Exported {metadata} to {exported_model}")
+    return exported_model
+
+
+def quantize_on_prepared_data(neural_net: nn.Module, config: DictConfig) -> nn.Module:
+    """Quantize a RandLANet to int8, calibrated on the first batches of prepared val data, and log the IoU of
+    each class and the speed before and after quantization on the next batches.
+
+    Args:
+        neural_net (nn.Module): RandLANet in eval mode.
+        config (DictConfig): Configuration composed by Hydra. Uses datamodule, predict.int8_calibration_batches
+        and predict.int8_evaluation_batches.
+
+    Returns:
+        nn.Module: int8 network, for CPU inference.
+
+    """
+    from lidar_multiclass.models.quantization import (
+        compare_to_fp32,
+        log_comparison,
+        quantize_int8,
+    )
+
+    assert hasattr(
+        neural_net, "set_linear_mlp"
+    ), "int8 quantization is only available for RandLANet."
+    datamodule = hydra.utils.instantiate(config.datamodule)
+    datamodule._set_val_data()
+    batches = (
+        datamodule.on_after_batch_transfer(batch, 0)
+        for batch in datamodule.val_dataloader()
+        if batch is not None
+    )
+    calibration_batches = list(
+        itertools.islice(batches, config.predict.get("int8_calibration_batches", 8))
+    )
+    evaluation_batches = list(
+        itertools.islice(batches, config.predict.get("int8_evaluation_batches", 8))
+    )
+    quantized_net = quantize_int8(neural_net, calibration_batches)
+    if evaluation_batches:
+        metrics = compare_to_fp32(
+            neural_net.cpu(),
+            quantized_net,
+            evaluation_batches,
+            datamodule.dataset_description.get("classification_dict"),
+        )
+        log_comparison(metrics)
+    else:
+        log.warning("No val batch left after calibration: IoU drift is not measured.")
+    return quantized_net
+
+
+def export_onnx(model: LightningModule, exported_model: str, config: DictConfig) -> str:
+    """Export the RandLANet of a Model to ONNX, with neighbors as inputs, and validate it against PyTorch.
+
+    Args:
+        model (LightningModule): Model loaded from checkpoint, in eval mode.
+        exported_model (str): path to the ONNX file to create.
+        config (DictConfig): Configuration composed by Hydra.
+
+    Returns:
+        str: path to the exported ONNX file.
+
+    """
+    import onnx
+
+    neural_net = model.model
+    assert hasattr(
+        neural_net, "forward_with_neighbors"
+    ), "ONNX export is only available for RandLANet."
+    neural_net.set_linear_mlp(config.predict.get("linear_mlp", False))
+    # Exporters restore the training mode of the wrapper on its children: it must be in eval mode too.
+    wrapper = NeighborsInputNeuralNet(neural_net).eval()
+    metadata = {
+        "neural_net_class_name": model.hparams.neural_net_class_name,
+        "num_points": config.datamodule.subsampler.subsample_size,
+        "d_in": model.hparams.d_in,
+        "num_neighbors": neural_net.num_neighbors,
+        "decimation": neural_net.decimation,
+        "num_levels": wrapper.num_levels,
+        "knn_backend": model.hparams.neural_net_hparams.get(
+            "knn_backend", "torch_points_kernels"
+        ),
+    }
+    example = torch.rand(
+        config.datamodule.batch_size, metadata["num_points"], metadata["d_in"]
+    )
+    inputs = get_neighbors_inputs(example, metadata)
+    input_names = wrapper.get_input_names()
+    dynamic_axes = {name: {0: "batch"} for name in input_names if name != "permutation"}
+    dynamic_axes["logits"] = {0: "batch"}
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            tuple(inputs[name] for name in input_names),
+            exported_model,
+            input_names=input_names,
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=ONNX_OPSET_VERSION,
+        )
+    onnx_model = onnx.load(exported_model)
+    onnx.helper.set_model_props(onnx_model, {ONNX_METADATA_KEY: json.dumps(metadata)})
+    onnx.save(onnx_model, exported_model)
+    log.info(f"Exported {metadata} to {exported_model}")
+
+    validate_onnx_model(
+        OnnxModel(exported_model, config.predict.get("onnx_intra_op_threads", 0)),
+        wrapper,
+        get_sample_input(config, metadata, example),
+    )
+    return exported_model
+
+
+@torch.no_grad()
+def validate_onnx_model(
+    onnx_model: "OnnxModel", wrapper: NeighborsInputNeuralNet, input: torch.Tensor
+) -> Dict[str, float]:
+    """Compare logits and predicted classes of an ONNX model to the ones of the PyTorch network it was exported from.
+
+    Both are given the same points order and neighbors.
+
+    Returns:
+        Dict[str, float]: max absolute difference of logits, and agreement of predicted classes.
+
+    """
+    inputs = get_neighbors_inputs(input, onnx_model.metadata)
+    reference = wrapper(*(inputs[name] for name in wrapper.get_input_names()))
+    logits = onnx_model.run(inputs)
+    metrics = {
+        "max_abs_difference": (logits - reference).abs().max().item(),
+        "predictions_agreement": (logits.argmax(-1) == reference.argmax(-1))
+        .float()
+        .mean()
+        .item(),
+    }
+    log.info(f"ONNX model compared to PyTorch: {metrics}")
+    return metrics
+
+
+def get_sample_input(
+    config: DictConfig, metadata: dict, default: torch.Tensor
+) -> torch.Tensor:
+    """Get a (B, N, d_in) dense input from the first batch of predict.src_las, if it is a file, else default."""
+    src_las = config.predict.get("src_las")
+    if not (src_las and os.path.isfile(src_las)):
+        log.warning("No sample tile at predict.src_las: validating ONNX model on random points.")
+        return default
+    datamodule = hydra.utils.instantiate(config.datamodule)
+    datamodule.predict_data = datamodule._get_predict_data([src_las])
+    for batch in datamodule.predict_dataloader():
+        if batch is not None:
+            batch = datamodule.on_after_batch_transfer(batch, 0)
+            input = torch.cat([batch.pos, batch.x], axis=1)
+            return input.view(batch.batch_size, -1, metadata["d_in"])
+    return default
+
+
+class OnnxModel:
+    """A RandLANet exported to ONNX by export(), run with onnxruntime, with the predict_step interface of Model."""
+
+    def __init__(self, path: str, intra_op_threads: int = 0):
+        """Initialization method.
+
+        Args:
+            path (str): path to the ONNX file.
+            intra_op_threads (int): number of threads used by onnxruntime within operators. 0 to let it decide.
+
+        """
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        self.session = onnxruntime.InferenceSession(
+            path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        custom_metadata = self.session.get_modelmeta().custom_metadata_map
+        self.metadata = json.loads(custom_metadata[ONNX_METADATA_KEY])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def run(self, inputs: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """Run the ONNX graph on inputs made by get_neighbors_inputs, and get (B, N, C) logits."""
+        feeds = {name: inputs[name].cpu().numpy() for name in self.input_names}
+        return torch.from_numpy(self.session.run(["logits"], feeds)[0])
+
+    @torch.no_grad()
+    def predict_step(self, batch) -> dict:
+        """Prediction step.
+
+        Args:
+            batch (torch_geometric.data.Batch): Batch of data including x (features) and pos (xyz positions),
+            in (B*N,C) format.
+
+        Returns:
+            dict: Dictionnary with predicted logits as well as input batch.
+
+        """
+        input = torch.cat([batch.pos, batch.x], axis=1)
+        input = input.view(batch.batch_size, -1, input.size(1))
+        logits = self.run(get_neighbors_inputs(input, self.metadata))
+        logits = logits.to(batch.pos.device)
+        return {"logits": logits.reshape(-1, logits.size(-1)), "batch": batch}
+
+
+class ExportedModel:
+    """A neural network exported by export(), with the predict_step interface of Model."""
+
+    def __init__(self, path: str, device):
+        extra_files = {EXPORT_METADATA_FILENAME: ""}
+        self.neural_net = torch.jit.load(
+            path, map_location="cpu", _extra_files=extra_files
+        )
+        self.metadata = json.loads(extra_files[EXPORT_METADATA_FILENAME])
+        if self.metadata.get("quantization") == "int8":
+            from lidar_multiclass.models.quantization import QUANTIZATION_ENGINE
+
+            # int8 weights are packed for the quantized engine when loaded, and only run on CPU.
+            if torch.backends.quantized.engine != QUANTIZATION_ENGINE:
+                torch.backends.quantized.engine = QUANTIZATION_ENGINE
+                self.neural_net = torch.jit.load(path, map_location="cpu")
+            device = torch.device("cpu")
+        elif torch.device(device).type != "cpu":
+            self.neural_net = torch.jit.load(path, map_location=device)
+        self.neural_net.eval()
+        self.device = device
+
+    @torch.no_grad()
+    def predict_step(self, batch) -> dict:
+        """Prediction step.
+
+        Args:
+            batch (torch_geometric.data.Batch): Batch of data including x (features) and pos (xyz positions),
+            in (B*N,C) format.
+
+        Returns:
+            dict: Dictionnary with predicted logits as well as input batch.
+
+        """
+        input = torch.cat([batch.pos, batch.x], axis=1)
+        input = input.view(batch.batch_size, -1, input.size(1))
+        assert input.shape[1:] == (self.metadata["num_points"], self.metadata["d_in"])
+        padding = self.metadata["batch_size"] - batch.batch_size
+        assert padding >= 0, "Batch size is larger than the one of the exported model."
+        if padding:
+            input = torch.cat([input, input[-1:].expand(padding, -1, -1)])
+        logits = self.neural_net(input.to(self.device))[: batch.batch_size]
+        logits = logits.to(batch.pos.device)
+        return {"logits": logits.reshape(-1, logits.size(-1)), "batch": batch}
+
+
+@hydra.main(config_path="../configs/", config_name="config.yaml")
+def main(config: DictConfig):
+    """See function {export.__name__}.
+
+    :meta private:
+
+    """
+    # Imports should be nested inside @hydra.main to optimize tab completion
+    # Read more here: https://github.com/facebookresearch/hydra/issues/934
+    from lidar_multiclass.utils import utils
+    from lidar_multiclass.export import export
+
+    utils.extras(config)
+
+    if config.get("print_config"):
+        utils.print_config(config, resolve=False)
+
+    return export(config)
+
+
+if __name__ == "__main__":
+    # cf. https://github.com/facebookresearch/hydra/issues/1283
+    OmegaConf.register_new_resolver("get_method", hydra.utils.get_method)
+    main()
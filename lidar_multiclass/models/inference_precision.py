@@ -0,0 +1,217 @@
+"""Reduced precision inference, and how it compares to fp32 inference in accuracy and speed.
+
+To compare inference modes of RandLANet on CPU, on a tile of the test set, run:
+
+    python -m lidar_multiclass.models.inference_precision --las {/path/to/prepared/test/tile.las} --checkpoint {/path/to/checkpoint.ckpt}
+
+A reduced precision mode passes if its predicted classes agree with the ones of fp32 inference for at least
+99% of points (see --min_agreement).
+
+"""
+
+import argparse
+import contextlib
+import time
+from numbers import Number
+from typing import Callable, Dict, Union
+
+import torch
+from torch import nn
+
+from lidar_multiclass.utils import utils
+
+log = utils.get_logger(__name__)
+
+INFERENCE_PRECISIONS = {"32": None, "bf16": torch.bfloat16, "16": torch.float16}
+# Minimal agreement of predicted classes with fp32 inference, for a reduced precision mode to pass.
+MIN_PREDICTIONS_AGREEMENT = 0.99
+
+
+def get_inference_autocast(device_type: str, precision: Union[int, str] = 32):
+    """Get a context in which inference runs at the requested precision.
+
+    Args:
+        device_type (str): "cpu" or "cuda".
+        precision (int or str): 32 for full precision, "bf16" for bfloat16 autocast, or 16 for float16 autocast.
+        float16 is only used on GPU, and replaced by bfloat16 on CPU.
+
+    """
+    try:
+        dtype = INFERENCE_PRECISIONS[str(precision)]
+    except KeyError:
+        raise KeyError(
+            f"Unknown inference precision {precision}. Choose among {list(INFERENCE_PRECISIONS)}."
+        )
+    if dtype is None:
+        return contextlib.nullcontext()
+    if dtype == torch.float16 and device_type == "cpu":
+        log.warning("float16 inference is not supported on CPU: using bfloat16.")
+        dtype = torch.bfloat16
+    return torch.autocast(device_type=device_type, dtype=dtype)
+
+
+@torch.no_grad()
+def compare_to_fp32(
+    net: nn.Module,
+    batch,
+    precision: Union[int, str] = "bf16",
+    linear_mlp: bool = True,
+    repeats: int = 3,
+) -> Dict[str, float]:
+    """Compare the logits of a network in an inference mode to the ones of the fp32 reference.
+
+    Args:
+        net (nn.Module): network in eval mode, e.g. RandLANet.
+        batch: input of the network, with pos, x and batch_size.
+        precision (int or str): see get_inference_autocast.
+        linear_mlp (bool): whether to use the Linear-based execution path of shared MLPs.
+        repeats (int): number of timed forward passes.
+
+    Returns:
+        Dict[str, float]: logits max and mean absolute difference, agreement of predicted classes,
+        and average duration of a forward pass for both the reference and the compared mode.
+
+    """
+    device_type = batch.pos.device.type
+
+    def timed_forward():
+        durations = []
+        for _ in range(repeats):
+            # RandLANet shuffles points at each forward pass.
+            torch.manual_seed(0)
+            ts = time.perf_counter()
+            logits = net(batch).float()
+            durations.append(time.perf_counter() - ts)
+        return logits, sum(durations) / repeats
+
+    net.set_linear_mlp(False)
+    reference, reference_duration = timed_forward()
+    net.set_linear_mlp(linear_mlp)
+    with get_inference_autocast(device_type, precision):
+        logits, duration = timed_forward()
+    net.set_linear_mlp(False)
+
+    difference = (logits - reference).abs()
+    agreement = (logits.argmax(1) == reference.argmax(1)).float().mean()
+    return {
+        "max_abs_difference": difference.max().item(),
+        "mean_abs_difference": difference.mean().item(),
+        "predictions_agreement": agreement.item(),
+        "fp32_seconds": reference_duration,
+        "seconds": duration,
+    }
+
+
+def get_fixture_batch(
+    las_filepath: str,
+    load_las: Callable,
+    batch_size: int,
+    subsample_size: int,
+    subtile_width_meters: Number = 50,
+):
+    """The first batch of subtiles of a real tile, e.g. of the test set, prepared like at predict time."""
+    from lidar_multiclass.data.datamodule import DataModule
+    from lidar_multiclass.data.transforms import CustomGridSampler
+
+    datamodule = DataModule(
+        batch_size=batch_size,
+        subtile_width_meters=subtile_width_meters,
+        subsampler=CustomGridSampler(subsample_size=subsample_size),
+        dataset_description={
+            "classification_dict": {},
+            "classification_preprocessing_dict": {},
+            "load_las_func": load_las,
+        },
+    )
+    datamodule.predict_data = datamodule._get_predict_data([las_filepath])
+    for batch in datamodule.predict_dataloader():
+        if batch is not None:
+            return datamodule.on_after_batch_transfer(batch, 0)
+    raise ValueError(f"No subtile to infer on in {las_filepath}.")
+
+
+def main():
+    """Compare the logits and speed of RandLANet inference modes to fp32 inference, on a real tile, on CPU."""
+    from lidar_multiclass.data.loading import FrenchLidarDataLogic, SwissTopoLidarDataLogic
+    from lidar_multiclass.models.modules.randla_net import RandLANet
+
+    data_logics = {"FR": FrenchLidarDataLogic, "CH": SwissTopoLidarDataLogic}
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "--las",
+        required=True,
+        type=str,
+        help="LAS tile to infer on, e.g. from the test set of a prepared dataset.",
+    )
+    parser.add_argument("--origin", default="FR", choices=list(data_logics))
+    parser.add_argument(
+        "--checkpoint",
+        default=None,
+        type=str,
+        help="Lightning checkpoint of a RandLANet model. Defaults to random weights.",
+    )
+    parser.add_argument("--batch_size", default=4, type=int)
+    parser.add_argument("--num_points", default=12500, type=int)
+    parser.add_argument("--knn_backend", default="grid", type=str)
+    parser.add_argument("--subtile_width_meters", default=50, type=float)
+    parser.add_argument("--repeats", default=3, type=int)
+    parser.add_argument(
+        "--min_agreement",
+        default=MIN_PREDICTIONS_AGREEMENT,
+        type=float,
+        help="Minimal agreement of predicted classes with fp32 inference, for a reduced precision mode to pass.",
+    )
+    args = parser.parse_args()
+    batch = get_fixture_batch(
+        args.las,
+        data_logics[args.origin].load_las,
+        args.batch_size,
+        args.num_points,
+        args.subtile_width_meters,
+    )
+
+    if args.checkpoint:
+        checkpoint = torch.load(args.checkpoint, map_location="cpu")
+        hparams_net = dict(checkpoint["hyper_parameters"]["neural_net_hparams"])
+        hparams_net["knn_backend"] = args.knn_backend
+        net = RandLANet(hparams_net)
+        net.load_state_dict(
+            {
+                key[len("model.") :]: value
+                for key, value in checkpoint["state_dict"].items()
+                if key.startswith("model.")
+            }
+        )
+    else:
+        torch.manual_seed(0)
+        net = RandLANet(
+            {"d_in": 3 + batch.x.size(1), "num_classes": 6, "knn_backend": args.knn_backend}
+        )
+    net.eval()
+
+    failed = []
+    for precision in ["32", "bf16"]:
+        for linear_mlp in [False, True]:
+            if precision == "32" and not linear_mlp:
+                continue
+            metrics = compare_to_fp32(net, batch, precision, linear_mlp, args.repeats)
+            passed = metrics["predictions_agreement"] >= args.min_agreement
+            if not passed:
+                failed.append(f"precision={precision} linear_mlp={linear_mlp}")
+            print(
+                f"precision={precision} linear_mlp={linear_mlp}: "
+                f"{metrics['seconds']:.2f}s vs {metrics['fp32_seconds']:.2f}s in fp32 | "
+                f"logits max abs difference {metrics['max_abs_difference']:.2e} "
+                f"(mean {metrics['mean_abs_difference']:.2e}) | "
+                f"predictions agreement {metrics['predictions_agreement']:.2%} "
+                f"({'passed' if passed else 'failed'}, min {args.min_agreement:.2%})"
+            )
+    if failed:
+        raise SystemExit(
+            f"Predictions agreement with fp32 inference below {args.min_agreement:.2%} "
+            f"for: {', '.join(failed)}."
+        )
+
+
+if __name__ == "__main__":
+    main()
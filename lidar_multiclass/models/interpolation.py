@@ -1,6 +1,7 @@
 """How we turn from prediction made on a subsampled subset of a Las to a complete point cloud."""
 
 import os
+from numbers import Number
 from typing import Dict, List, Optional, Literal, Union
 
 import pdal
@@ -18,7 +19,13 @@ log = utils.get_logger(__name__)
 
 
 class Interpolator:
-    """A class to load, update with classification, update with probas (optionnal), and save a LAS."""
+    """A class to load, update with classification, update with probas (optionnal), and save a LAS.
+
+    Logits predicted on the subsampled points of a window are interpolated to the other points of the window. All
+    points are identified by their index in the LAS (see KeepFullResolutionIdxAndY). Interpolated logits of overlapping windows are merged point by point,
+    with a running sum (or max) and a count of windows for each LAS point. In streaming mode, those are only kept for points yet to be written.
+
+    """
 
     def __init__(
         self,
@@ -26,6 +33,9 @@ class Interpolator:
         classification_dict: Dict[int, str] = {},
         probas_to_save: Union[List[str], Literal["all"]] = "all",
         output_dir: Optional[str] = None,
+        streaming: bool = False,
+        streaming_margin_meters: Number = 50,
+        overlap_merge: Literal["mean", "max"] = "mean",
     ):
         """Initialization method.
 
@@ -36,6 +46,12 @@ class Interpolator:
             Override with None for no saving of probabilitiues. Defaults to "all".
             output_dir (Optional[str], optional): Directory to save output LAS with new predicted classification, entropy,
             and probabilities. Defaults to None.
+            streaming (bool, optional): At predict time, write predictions as soon as no upcoming window can change
+            them, instead of once all windows of a LAS were seen. Defaults to False.
+            streaming_margin_meters (Number, optional): In streaming mode, predictions lying further than this
+            distance (in x) behind the first point still waiting for its final logits are dropped. Defaults to 50.
+            overlap_merge ("mean" or "max", optional): How logits of a point in overlapping windows are merged.
+            Defaults to "mean".
 
         """
         self.output_dir = output_dir
@@ -58,6 +74,15 @@ class Interpolator:
             for class_index, class_code in enumerate(classification_dict.keys())
         }
 
+        self.reverse_lookup_table = np.array(
+            list(self.reverse_mapper.values()), dtype=np.int64
+        )
+
+        self.streaming = streaming
+        self.streaming_margin_meters = streaming_margin_meters
+        assert overlap_merge in ["mean", "max"], "overlap_merge must be mean or max."
+        self.overlap_merge = overlap_merge
+
         # Tracker for current processed file.
         self.current_f = ""
 
@@ -92,14 +117,30 @@ class Interpolator:
                 dtype=np.float32,
             ).transpose()
         )
+        # Merged logits and number of windows of each LAS point, allocated with the first logits.
+        # In streaming mode, rows are only kept for pending points, whose sorted LAS indices are merged_idx.
+        self.logits = None
+        self.counts = None
+        self.merged_idx = None
+        # In streaming mode: windows seen since the frontier last moved, yet to be merged.
+        self.window_point_idx_l = []
+        self.window_logits_l = []
+        # Targets of each LAS point, at test time. -1 for points in no window.
+        self.targets = None
+        # Predictions on subsampled points, for points in no window (e.g. in filtered out windows).
         self.logits_sub_l = []
-        self.targets_l = []
         self.pos_sub_l = []
-        self.pos_l = []
+
+        # In streaming mode: indices of LAS points yet to be written, sorted by x, and
+        # the x of the column of windows being predicted on.
+        self.pending_idx = None
+        if self.streaming:
+            self.pending_idx = torch.argsort(self.pos_las[:, 0])
+        self.frontier = -float("inf")
 
     @torch.no_grad()
     def update(self, outputs: dict):
-        """Keep a list of predictions made so far.
+        """Merge the predictions of a batch of windows into the logits of their LAS points.
         In Test phase, interpolation and saving are trigerred when a new file is encountered.
 
         Args:
@@ -114,77 +155,280 @@ class Interpolator:
         _itps = []
 
         batch = outputs["batch"].detach()
-        logits_b = outputs["logits"].detach()
-        some_targets_to_interpolate = "y_copy" in batch
-        if some_targets_to_interpolate:
-            # TODO: it seems that this is always done due to data transforms.
-            targets_b = batch.y_copy.detach()
+        logits_b = outputs["logits"].detach().float().cpu()
+        pos_sub_b = batch.pos_copy_subsampled.cpu()
+        sub_point_idx_b = batch.point_idx.cpu()
+        point_idx_b = batch.point_idx_copy.cpu()
+        batch_x = batch.batch_x.cpu()
+        batch_y = batch.batch_y.cpu()
+        # Targets are only kept for IoU computation, which streaming is not meant for.
+        some_targets_to_keep = "y_copy" in batch and not self.streaming
+        if some_targets_to_keep:
+            targets_b = batch.y_copy.cpu()
 
         for batch_idx, las_filepath in enumerate(batch.las_filepath):
             is_a_new_tile = las_filepath != self.current_f
             if is_a_new_tile:
                 close_previous_las_first = self.current_f != ""
-                if close_previous_las_first:
+                if close_previous_las_first and self.streaming:
+                    if self.output_dir:
+                        self.interpolate_and_save()
+                elif close_previous_las_first:
                     interpolation = self._interpolate()
                     if self.output_dir:
                         self._write(interpolation)
                     _itps += [interpolation]
                 self._load_las(las_filepath)
 
-            # subsampled elements
-            idx_x = batch.batch_x == batch_idx
-            self.logits_sub_l.append(logits_b[idx_x])
-            self.pos_sub_l.append(batch.pos_copy_subsampled[idx_x])
+            if self.streaming:
+                # All windows with a lower x_min have been seen.
+                window_x_min = float(batch.xy_min_corner[batch_idx][0])
+                if window_x_min > self.frontier:
+                    self._set_completed_points(window_x_min)
 
-            if some_targets_to_interpolate:
-                # non-sampled elements
-                idx_y = batch.batch_y == batch_idx
-                self.pos_l.append(batch.pos_copy[idx_y])
-                self.targets_l.append(targets_b[idx_y])
+            # subsampled elements
+            idx_x = batch_x == batch_idx
+            logits_sub = logits_b[idx_x]
+            pos_sub = pos_sub_b[idx_x]
+            self.logits_sub_l.append(logits_sub)
+            self.pos_sub_l.append(pos_sub)
+
+            # all elements of the window
+            idx_y = batch_y == batch_idx
+            point_idx = point_idx_b[idx_y]
+            logits = self._interpolate_window(
+                logits_sub, pos_sub, sub_point_idx_b[idx_x], point_idx
+            )
+            self._merge(point_idx, logits)
+
+            if some_targets_to_keep:
+                if self.targets is None:
+                    self.targets = torch.full((len(self.pos_las),), -1, dtype=torch.long)
+                self.targets[point_idx] = targets_b[idx_y]
 
         return _itps
 
+    def _interpolate_window(
+        self,
+        logits_sub: torch.Tensor,
+        pos_sub: torch.Tensor,
+        sub_point_idx: torch.Tensor,
+        point_idx: torch.Tensor,
+    ) -> torch.Tensor:
+        """Get the logits of all points of a window from the ones of its subsampled points.
+
+        Subsampled points are found among the window points by their LAS index, and keep their own logits.
+        Only the other points are interpolated.
+
+        Args:
+            logits_sub (torch.Tensor): (n, C) logits of subsampled points.
+            pos_sub (torch.Tensor): (n, 3) positions of subsampled points.
+            sub_point_idx (torch.Tensor): (n) LAS index of subsampled points, which may repeat.
+            point_idx (torch.Tensor): (N) LAS index of all points of the window, without repetition.
+
+        Returns:
+            torch.Tensor: (N, C) logits of all points of the window.
+
+        """
+        sorted_point_idx, order = torch.sort(point_idx)
+        sampled = order[torch.searchsorted(sorted_point_idx, sub_point_idx)]
+        logits = torch.empty((len(point_idx), logits_sub.size(1)))
+        is_sampled = torch.zeros(len(point_idx), dtype=torch.bool)
+        is_sampled[sampled] = True
+        logits[sampled] = logits_sub
+        if not is_sampled.all():
+            logits[~is_sampled] = knn_interpolate(
+                logits_sub,
+                pos_sub,
+                self.pos_las[point_idx[~is_sampled]],
+                batch_x=None,
+                batch_y=None,
+                k=self.k,
+                num_workers=4,
+            )
+        return logits
+
+    def _merge(self, point_idx: torch.Tensor, logits: torch.Tensor):
+        """Merge the logits of the points of a window into the logits of their LAS points.
+
+        In streaming mode, windows are only kept until the frontier moves (see _merge_windows).
+
+        """
+        if self.streaming:
+            self.window_point_idx_l.append(point_idx)
+            self.window_logits_l.append(logits)
+            return
+        if self.logits is None:
+            self.logits = self._get_empty_logits(len(self.pos_las), logits.size(1))
+            self.counts = torch.zeros(len(self.pos_las), dtype=torch.int32)
+        self._merge_rows(point_idx, logits)
+
+    def _merge_windows(self):
+        """Streaming mode: merge the windows seen since the frontier last moved into the logits of pending points.
+
+        Rows of the merged logits and counts are those of the sorted LAS indices of the points in these windows,
+        and of the pending points that were already merged.
+
+        """
+        if not self.window_point_idx_l:
+            return
+        num_classes = self.window_logits_l[0].size(1)
+        if self.logits is None:
+            self.merged_idx = torch.empty(0, dtype=torch.long)
+            self.logits = self._get_empty_logits(0, num_classes)
+            self.counts = torch.zeros(0, dtype=torch.int32)
+
+        merged_idx, rows = torch.unique(
+            torch.cat([self.merged_idx] + self.window_point_idx_l), return_inverse=True
+        )
+        previous_rows = rows[: len(self.merged_idx)]
+        logits = self._get_empty_logits(len(merged_idx), num_classes)
+        logits[previous_rows] = self.logits
+        counts = torch.zeros(len(merged_idx), dtype=torch.int32)
+        counts[previous_rows] = self.counts
+        self.merged_idx, self.logits, self.counts = merged_idx, logits, counts
+
+        start = len(previous_rows)
+        for window_logits in self.window_logits_l:
+            end = start + len(window_logits)
+            self._merge_rows(rows[start:end], window_logits)
+            start = end
+        self.window_point_idx_l = []
+        self.window_logits_l = []
+
+    def _get_empty_logits(self, num_points: int, num_classes: int) -> torch.Tensor:
+        """Get merged logits of points in no window yet."""
+        initial_value = 0.0 if self.overlap_merge == "mean" else -float("inf")
+        return torch.full((num_points, num_classes), initial_value)
+
+    def _merge_rows(self, rows: torch.Tensor, logits: torch.Tensor):
+        """Merge the logits of the points of a window into the rows of the merged logits, without repetition."""
+        if self.overlap_merge == "mean":
+            self.logits.index_add_(0, rows, logits)
+        else:
+            self.logits[rows] = torch.maximum(self.logits[rows], logits)
+        self.counts[rows] += 1
+
+    def _get_logits(self, idx: torch.Tensor) -> torch.Tensor:
+        """Get the final logits of LAS points at idx, once all windows containing them were merged.
+
+        Points in no window get the logits of their nearest predictions among the subsampled points.
+
+        """
+        if self.streaming:
+            rows = torch.searchsorted(self.merged_idx, idx)
+            in_range = rows < len(self.merged_idx)
+            covered = torch.zeros_like(in_range)
+            covered[in_range] = self.merged_idx[rows[in_range]] == idx[in_range]
+        else:
+            rows = idx
+            covered = self.counts[idx] > 0
+        num_classes = self.logits.size(1)
+        logits = torch.empty((len(idx), num_classes))
+        logits[covered] = self.logits[rows[covered]]
+        if self.overlap_merge == "mean":
+            logits[covered] /= self.counts[rows[covered]].unsqueeze(-1)
+        if not covered.all():
+            logits[~covered] = knn_interpolate(
+                torch.cat(self.logits_sub_l),
+                torch.cat(self.pos_sub_l),
+                self.pos_las[idx[~covered]],
+                batch_x=None,
+                batch_y=None,
+                k=self.k,
+                num_workers=4,
+            )
+        return logits
+
     def _interpolate(self):
-        """Interpolate logits to points without predictions using an inverse-distance weightning scheme.
+        """Get the merged logits of all LAS points, and their targets if known.
 
         Returns:
             torch.Tensor, torch.Tensor: interpolated logits and targets/original classification
 
         """
 
-        # Cat
-        pos_sub = torch.cat(self.pos_sub_l).cpu()
-        logits_sub = torch.cat(self.logits_sub_l).cpu()
-
-        # Find nn among points with predictions for all points
-        logits = knn_interpolate(
-            logits_sub,
-            pos_sub,
-            self.pos_las,
-            batch_x=None,
-            batch_y=None,
-            k=self.k,
-            num_workers=4,
-        )
+        if self.streaming:
+            raise RuntimeError(
+                "Streaming interpolation does not keep complete logits and targets. Use interpolate_and_save."
+            )
+
+        logits = self._get_logits(torch.arange(len(self.pos_las)))
         # If no target, returns interpolared logits (i.e. at predict time)
-        if not self.targets_l:
+        if self.targets is None:
             return logits, None
 
-        # Interpolate non-sampled targets if present (i.e. at test time)
-        targets = torch.cat(self.targets_l).cpu()
-        pos = torch.cat(self.pos_l).cpu()
-        assign_idx = knn(pos, self.pos_las, k=1, num_workers=4)
-        _, x_idx = assign_idx
-        targets = targets[x_idx]
+        # Points in no window take the target of their nearest point in a window (i.e. at test time)
+        targets = self.targets
+        missing = targets < 0
+        if missing.any():
+            known_idx = torch.nonzero(~missing).squeeze(-1)
+            _, x_idx = knn(self.pos_las[known_idx], self.pos_las[missing], k=1)
+            targets = targets.clone()
+            targets[missing] = targets[known_idx[x_idx]]
 
         return logits, targets
 
+    @torch.no_grad()
+    def _set_completed_points(self, frontier: float):
+        """Streaming mode: set the predictions of pending points that no upcoming window contains.
+
+        Upcoming windows only hold points with x >= frontier, so that pending points with a lower x are final.
+        Their predictions are written into the LAS arrays, and their merged logits are dropped, as well as
+        subsampled predictions that are far behind the remaining pending points.
+
+        Args:
+            frontier (float): x_min of the upcoming windows, or inf when all windows were seen.
+
+        """
+        self.frontier = frontier
+        self._merge_windows()
+        if self.logits is None:
+            return
+
+        pending_x = self.pos_las[self.pending_idx, 0]
+        num_completed = int(torch.searchsorted(pending_x, frontier))
+        completed = self.pending_idx[:num_completed]
+        if num_completed:
+            self._set_predictions(completed.numpy(), self._get_logits(completed))
+        self.pending_idx = self.pending_idx[num_completed:]
+
+        kept = self.pos_las[self.merged_idx, 0] >= frontier
+        self.merged_idx = self.merged_idx[kept]
+        self.logits = self.logits[kept]
+        self.counts = self.counts[kept]
+
+        pos_sub = torch.cat(self.pos_sub_l)
+        logits_sub = torch.cat(self.logits_sub_l)
+        if len(self.pending_idx):
+            min_pending_x = self.pos_las[self.pending_idx[0], 0]
+            kept = pos_sub[:, 0] >= min_pending_x - self.streaming_margin_meters
+            pos_sub, logits_sub = pos_sub[kept], logits_sub[kept]
+        self.pos_sub_l = [pos_sub]
+        self.logits_sub_l = [logits_sub]
+
+    def _set_predictions(self, idx, logits: torch.Tensor):
+        """Set probabilities, predicted classification and entropy of LAS points at idx, from their logits."""
+        probas = torch.nn.Softmax(dim=1)(logits)
+        for idx_c, class_name in enumerate(self.classification_dict.values()):
+            if class_name in self.probas_to_save:
+                self.las[class_name][idx] = probas[:, idx_c]
+
+        preds = torch.argmax(logits, dim=1)
+        self.las[ChannelNames.PredictedClassification.value][
+            idx
+        ] = self.reverse_lookup_table[preds.numpy()]
+
+        entropy = Categorical(probs=probas).entropy()
+        self.las[ChannelNames.ProbasEntropy.value][idx] = entropy
+
     @torch.no_grad()
     def _write(self, interpolation) -> str:
         """Interpolate all predicted probabilites to their original points in LAS file, and save.
 
         Args:
             interpolation (torch.Tensor, torch.Tensor): output of _interpolate, of which we need the logits.
+            In streaming mode, None since predictions were already set.
 
         Returns:
             str: path of the updated, saved LAS file.
@@ -195,19 +439,9 @@ class Interpolator:
         out_f = os.path.join(self.output_dir, basename)
         log.info(f"Updated LAS will be saved to {out_f}")
 
-        logits, _ = interpolation
-
-        probas = torch.nn.Softmax(dim=1)(logits)
-        for idx, class_name in enumerate(self.classification_dict.values()):
-            if class_name in self.probas_to_save:
-                self.las[class_name][:] = probas[:, idx]
-
-        preds = torch.argmax(logits, dim=1)
-        preds = np.vectorize(self.reverse_mapper.get)(preds)
-        self.las[ChannelNames.PredictedClassification.value][:] = preds
-
-        entropy = Categorical(probs=probas).entropy()
-        self.las[ChannelNames.ProbasEntropy.value][:] = entropy
+        if interpolation is not None:
+            logits, _ = interpolation
+            self._set_predictions(slice(None), logits)
 
         log.info(f"Saving...")
 
@@ -221,6 +455,9 @@ class Interpolator:
 
     def interpolate_and_save(self):
         """Interpolate and save in a single method, for predictions."""
+        if self.streaming:
+            self._set_completed_points(float("inf"))
+            return self._write(None)
         interpolation = self._interpolate()
         out_f = self._write(interpolation)
 
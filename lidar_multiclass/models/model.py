@@ -7,6 +7,7 @@ from torch_geometric.data import Batch
 from torchmetrics import MaxMetric
 from lidar_multiclass.models.modules.randla_net import RandLANet
 from lidar_multiclass.models.modules.point_net import PointNet
+from lidar_multiclass.models.inference_precision import get_inference_autocast
 from lidar_multiclass.utils import utils
 
 log = utils.get_logger(__name__)
@@ -50,6 +51,19 @@ class Model(LightningModule):
         self.model = neural_net_class(self.hparams.neural_net_hparams)
 
         self.softmax = nn.Softmax(dim=1)
+        self.inference_precision = 32
+
+    def set_inference_mode(self, precision=32, linear_mlp: bool = False):
+        """Set how predictions are made by predict_step.
+
+        Args:
+            precision (int or str): 32, "bf16" or 16, see inference_precision.get_inference_autocast.
+            linear_mlp (bool): use the Linear-based execution path of the network shared MLPs, if it has one.
+
+        """
+        self.inference_precision = precision
+        if hasattr(self.model, "set_linear_mlp"):
+            self.model.set_linear_mlp(linear_mlp)
 
     def setup(self, stage: Optional[str]) -> None:
         """Setup stage: prepare to compute IoU and loss."""
@@ -171,8 +185,11 @@ class Model(LightningModule):
 
         Returns:
             dict: Dictionnary with predicted logits as well as input batch.
+            None if the batch is empty, which happens with multiple dataloader workers.
 
         """
+        if batch is None:
+            return None
         logits = self.forward(batch)
         return {"logits": logits, "batch": batch}
 
@@ -187,8 +204,9 @@ class Model(LightningModule):
             dict: Dictionnary with predicted logits as well as input batch.
 
         """
-        logits = self.forward(batch)
-        return {"logits": logits, "batch": batch}
+        with get_inference_autocast(self.device.type, self.inference_precision):
+            logits = self.forward(batch)
+        return {"logits": logits.float(), "batch": batch}
 
     def get_neural_net_class(self, class_name: str) -> nn.Module:
         """A Class Factory to class of neural net based on class name.
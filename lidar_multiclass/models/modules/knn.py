@@ -0,0 +1,231 @@
+"""Neighbor search backends for RandLANet.
+
+All backends share the signature of torch_points_kernels' knn:
+
+    idx, dist2 = knn_function(support, query, k)
+
+with support (B, M, 3), query (B, Q, 3), and idx (B, Q, k) the indices of the k nearest neighbors in support
+of each query point, sorted by increasing squared distance dist2 (B, Q, k). Results are on the device of query.
+
+To compare backends on CPU, run:
+
+    python -m lidar_multiclass.models.modules.knn -h
+
+"""
+
+import argparse
+import math
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+# Maximal number of (query, candidate) pairs whose distances are held in memory at once.
+MAX_PAIRS_PER_CHUNK = 2**25
+
+
+def knn_torch_points_kernels(
+    support: torch.Tensor, query: torch.Tensor, k: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """CPU kernel of torch_points_kernels. Inputs are copied to CPU and outputs back to the input device."""
+    from torch_points_kernels import knn
+
+    idx, dist2 = knn(support.cpu().contiguous(), query.cpu().contiguous(), k)
+    return idx.to(query.device), dist2.to(query.device)
+
+
+def knn_brute_force(
+    support: torch.Tensor, query: torch.Tensor, k: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Exhaustive search on the input device, by chunks of query points to bound memory."""
+    B, M, _ = support.shape
+    chunk_size = max(1, MAX_PAIRS_PER_CHUNK // (B * M))
+    idx_l, dist2_l = [], []
+    for query_chunk in torch.split(query, chunk_size, dim=1):
+        dist2 = torch.cdist(query_chunk, support).pow_(2)
+        dist2_chunk, idx_chunk = dist2.topk(k, dim=-1, largest=False)
+        idx_l.append(idx_chunk)
+        dist2_l.append(dist2_chunk)
+    return torch.cat(idx_l, dim=1), torch.cat(dist2_l, dim=1)
+
+
+def knn_grid(
+    support: torch.Tensor,
+    query: torch.Tensor,
+    k: int,
+    cell_size: Optional[float] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Search among the support points of the 3x3 xy grid cells around each query point, on the input device.
+
+    Support points are bucketed by xy cell in a single sort. The candidates of a query are exactly its k
+    nearest neighbors if the k-th one is closer than the cell size, which holds for most points with the
+    default cell size (about k support points per cell). The remaining queries are searched again with
+    larger cells.
+
+    Args:
+        cell_size (float, optional): width of the grid cells. Defaults to None, to adapt to the point density.
+
+    """
+    B, M, _ = support.shape
+    Q = query.size(1)
+    device = query.device
+    xy_support = support[..., :2]
+    xy_query = query[..., :2]
+    low = torch.minimum(xy_support.amin(1), xy_query.amin(1))  # B, 2
+    high = torch.maximum(xy_support.amax(1), xy_query.amax(1))
+    if cell_size is None:
+        area = (high - low).clamp(min=1e-6).prod(-1).max().item()
+        cell_size = math.sqrt(area * k / M)
+    num_cells = ((high - low) / cell_size).floor().long().amax(0) + 1  # 2
+    nx, ny = num_cells.tolist()
+
+    # Sort support points by cell key, with cells of different samples kept apart.
+    batch_offset = torch.arange(B, device=device).view(B, 1) * (nx * ny)
+    cells_support = ((xy_support - low.unsqueeze(1)) / cell_size).floor().long()
+    keys = batch_offset + cells_support[..., 0] * ny + cells_support[..., 1]
+    order = torch.argsort(keys.flatten())
+    sorted_support = support.reshape(B * M, 3)[order]
+    counts = torch.bincount(keys.flatten(), minlength=B * nx * ny)
+    ends = torch.cumsum(counts, 0)
+
+    # Cells (x, y-1), (x, y), (x, y+1) are contiguous in sorted order: the 3x3 cells around
+    # a query point are visited as 3 ranges of sorted support points.
+    cells_query = ((xy_query - low.unsqueeze(1)) / cell_size).floor().long()
+    cx = cells_query[..., 0:1] + torch.tensor([-1, 0, 1], device=device)  # B, Q, 3
+    cy = cells_query[..., 1:2]
+    first_key = batch_offset.unsqueeze(-1) + cx.clamp(0, nx - 1) * ny
+    range_starts = ends[first_key + (cy - 1).clamp(min=0)] - counts[
+        first_key + (cy - 1).clamp(min=0)
+    ]
+    range_ends = ends[first_key + (cy + 1).clamp(max=ny - 1)]
+    range_ends = torch.where((cx >= 0) & (cx < nx), range_ends, range_starts)
+    range_lengths = range_ends - range_starts
+    # At least one candidate, masked if all ranges are empty: such queries are searched again below.
+    max_length = max(1, int(range_lengths.max()))
+
+    rank = torch.arange(max_length, device=device)
+    chunk_size = max(1, MAX_PAIRS_PER_CHUNK // (B * 3 * max_length))
+    idx = torch.empty((B, Q, k), dtype=torch.long, device=device)
+    dist2 = torch.empty((B, Q, k), dtype=query.dtype, device=device)
+    for q_start in range(0, Q, chunk_size):
+        q_slice = slice(q_start, q_start + chunk_size)
+        is_candidate = (rank < range_lengths[:, q_slice].unsqueeze(-1)).flatten(2)
+        candidates = (range_starts[:, q_slice].unsqueeze(-1) + rank).flatten(2)
+        candidates = candidates.clamp(max=B * M - 1)  # B, q, 3 * max_length, indices in sorted_support
+        candidates_dist2 = (
+            (sorted_support[candidates] - query[:, q_slice].unsqueeze(2)).pow(2).sum(-1)
+        )
+        candidates_dist2 = candidates_dist2.masked_fill(~is_candidate, float("inf"))
+        k_candidates = min(k, candidates_dist2.size(-1))
+        dist2_chunk, rank_chunk = candidates_dist2.topk(
+            k_candidates, dim=-1, largest=False
+        )
+        if k_candidates < k:
+            # Less candidates than k: those queries are searched again below.
+            padding = (0, k - k_candidates)
+            dist2_chunk = F.pad(dist2_chunk, padding, value=float("inf"))
+            rank_chunk = F.pad(rank_chunk, padding)
+        idx[:, q_slice] = order[torch.gather(candidates, -1, rank_chunk)] % M
+        dist2[:, q_slice] = dist2_chunk
+
+    # Neighbors further than a cell may lie outside of the visited cells, unless all cells were visited.
+    if nx <= 2 and ny <= 2:
+        return idx, dist2
+    inexact = ~(dist2[..., -1] <= cell_size**2)
+    for b in torch.nonzero(inexact.any(-1)).flatten().tolist():
+        idx_b, dist2_b = knn_grid(
+            support[b : b + 1], query[b : b + 1, inexact[b]], k, cell_size * 2
+        )
+        idx[b, inexact[b]] = idx_b[0]
+        dist2[b, inexact[b]] = dist2_b[0]
+    return idx, dist2
+
+
+KNN_BACKENDS: Dict[str, Callable] = {
+    "torch_points_kernels": knn_torch_points_kernels,
+    "brute_force": knn_brute_force,
+    "grid": knn_grid,
+}
+
+
+def get_knn_function(knn_backend: str) -> Callable:
+    """Get a neighbor search function by its name, among the keys of KNN_BACKENDS."""
+    try:
+        return KNN_BACKENDS[knn_backend]
+    except KeyError:
+        raise KeyError(
+            f"Unknown knn_backend {knn_backend}. Choose among {list(KNN_BACKENDS)}."
+        )
+
+
+def benchmark(
+    batch_size: int, num_points: int, num_neighbors: int, decimation: int, repeats: int
+):
+    """Time each backend on the searches of a RandLANet forward pass, and check results against the first backend.
+
+    Points mimic a normalized subtile: xy in (-1, 1), on a smooth ground surface, with 20% of points spread above
+    it like vegetation.
+
+    """
+    xy = torch.rand(batch_size, num_points, 2) * 2 - 1
+    z = 0.05 * torch.sin(3 * xy[..., 0]) * torch.cos(2 * xy[..., 1])
+    z += (torch.rand(batch_size, num_points) < 0.2) * torch.rand(batch_size, num_points) * 0.2
+    pos = torch.cat([xy, z.unsqueeze(-1)], dim=-1)
+    searches = []
+    for level in range(4):
+        n = num_points // decimation**level
+        searches.append((f"encoder level {level}", pos[:, :n], pos[:, :n], num_neighbors))
+    for level in range(4, 0, -1):
+        searches.append(
+            (
+                f"decoder level {level}",
+                pos[:, : num_points // decimation**level],
+                pos[:, : num_points // decimation ** (level - 1)],
+                1,
+            )
+        )
+
+    reference = {}
+    for name, knn_function in KNN_BACKENDS.items():
+        try:
+            knn_function(pos[:, :16], pos[:, :16], 1)
+        except ImportError:
+            print(f"{name}: not available")
+            continue
+        total = 0.0
+        max_error = 0.0
+        for search_name, support, query, k in searches:
+            ts = time.perf_counter()
+            for _ in range(repeats):
+                _, dist2 = knn_function(support, query, k)
+            total += (time.perf_counter() - ts) / repeats
+            if search_name in reference:
+                max_error = max(max_error, (dist2 - reference[search_name]).abs().max().item())
+            else:
+                reference[search_name] = dist2
+        print(
+            f"{name}: {total * 1000:.1f} ms per forward pass | "
+            f"max squared distance difference {max_error:.2e}"
+        )
+
+
+def main():
+    """Benchmark neighbor search backends on CPU, with the sizes of a RandLANet forward pass."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--batch_size", default=4, type=int)
+    parser.add_argument("--num_points", default=12500, type=int)
+    parser.add_argument("--num_neighbors", default=16, type=int)
+    parser.add_argument("--decimation", default=4, type=int)
+    parser.add_argument("--repeats", default=3, type=int)
+    parser.add_argument("--num_threads", default=None, type=int)
+    args = parser.parse_args()
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    benchmark(
+        args.batch_size, args.num_points, args.num_neighbors, args.decimation, args.repeats
+    )
+
+
+if __name__ == "__main__":
+    main()
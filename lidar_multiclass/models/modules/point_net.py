@@ -54,6 +54,25 @@ class PointNet(nn.Module):
 
         return logits
 
+    def forward_dense(self, input):
+        """Forward pass on a dense input of B subtiles of N points, with shape (B, N, 3+F).
+
+        Returns:
+            torch.Tensor: logits, with shape (B, N, C).
+
+        """
+        B, N, _ = input.size()
+        f1 = self.mlp1(input.reshape(B * N, -1))
+        f2 = self.mlp2(f1)
+        context_vector = f2.view(B, N, -1).max(dim=1).values
+        expanded_context_vector = (
+            context_vector.unsqueeze(1).expand((-1, N, -1)).reshape(B * N, -1)
+        )
+        Gf1 = torch.cat((expanded_context_vector, f1), 1)
+        f3 = self.mlp3(Gf1)
+        logits = self.lin(f3)
+        return logits.view(B, N, -1)
+
     def change_num_class_for_finetuning(self, new_num_classes: int):
         """
         Change end layer output number of classes if new_num_classes is different.
@@ -3,7 +3,10 @@
 import torch
 import torch.nn as nn
 
-from torch_points_kernels import knn
+from lidar_multiclass.models.modules.knn import (
+    get_knn_function,
+    knn_torch_points_kernels,
+)
 
 
 class RandLANet(nn.Module):
@@ -16,6 +19,7 @@ class RandLANet(nn.Module):
     Our modifications:
     - fc_start = nn.Linear(d_in, d_in * 2) instead of self.fc_start = nn.Linear(d_in, 8) to avoid
     information bottleneck in cases where d_in is above 8.
+    - neighbor search backend can be chosen with knn_backend (see lidar_multiclass.models.modules.knn).
 
     """
 
@@ -26,6 +30,9 @@ class RandLANet(nn.Module):
         self.decimation = hparams_net.get("decimation", 4)
         self.dropout = hparams_net.get("dropout", 0.0)
         self.num_classes = hparams_net.get("num_classes", 6)
+        self.knn_function = get_knn_function(
+            hparams_net.get("knn_backend", "torch_points_kernels")
+        )
 
         self.fc_start = nn.Linear(self.d_in, self.d_in * 2)
         self.bn_start = nn.Sequential(
@@ -35,10 +42,16 @@ class RandLANet(nn.Module):
         # encoding layers
         self.encoder = nn.ModuleList(
             [
-                LocalFeatureAggregation(self.d_in * 2, 16, self.num_neighbors),
-                LocalFeatureAggregation(32, 64, self.num_neighbors),
-                LocalFeatureAggregation(128, 128, self.num_neighbors),
-                LocalFeatureAggregation(256, 256, self.num_neighbors),
+                LocalFeatureAggregation(
+                    self.d_in * 2, 16, self.num_neighbors, self.knn_function
+                ),
+                LocalFeatureAggregation(32, 64, self.num_neighbors, self.knn_function),
+                LocalFeatureAggregation(
+                    128, 128, self.num_neighbors, self.knn_function
+                ),
+                LocalFeatureAggregation(
+                    256, 256, self.num_neighbors, self.knn_function
+                ),
             ]
         )
 
@@ -86,9 +99,47 @@ class RandLANet(nn.Module):
         """
 
         input = torch.cat([batch.pos, batch.x], axis=1)
-        chunks = torch.split(input, len(batch.pos) // batch.batch_size)
-        input = torch.stack(chunks)  # B, N, 3+F
+        input = input.view(batch.batch_size, -1, input.size(1))  # B, N, 3+F
+        scores = self.forward_dense(input)
+        return scores.reshape(-1, scores.size(-1))  # B*N, C
+
+    def forward_dense(self, input):
+        """Forward pass on a dense input, with no Python-level handling of the batch. This is what gets exported.
+
+        Args:
+            input (torch.Tensor): XYZ positions and features of subtiles, with shape (B, N, 3+F).
+
+        Returns:
+            torch.Tensor: classification logits for each point, with shape (B, N, C)
+
+        """
+        permutation = torch.randperm(input.size(1))
+        knn_outputs, upsampling_neighbors = search_neighbors(
+            input[:, permutation, :3],
+            self.knn_function,
+            self.num_neighbors,
+            self.decimation,
+            len(self.encoder),
+        )
+        return self.forward_with_neighbors(
+            input, permutation, knn_outputs, upsampling_neighbors
+        )
+
+    def forward_with_neighbors(
+        self, input, permutation, knn_outputs, upsampling_neighbors
+    ):
+        """Forward pass on a dense input, with points order and neighbors already known (see search_neighbors).
+
+        Args:
+            input (torch.Tensor): XYZ positions and features of subtiles, with shape (B, N, 3+F).
+            permutation (torch.Tensor): (N) random order of points, which sets the points kept at each level.
+            knn_outputs (List[Tuple[torch.Tensor, torch.Tensor]]): neighbors indices and squared distances at each level.
+            upsampling_neighbors (List[torch.Tensor]): nearest neighbor in next level of each point of a level.
 
+        Returns:
+            torch.Tensor: classification logits for each point, with shape (B, N, C)
+
+        """
         N = input.size(1)
         d = self.decimation
 
@@ -101,14 +152,13 @@ class RandLANet(nn.Module):
         # <<<<<<<<<< ENCODER
         x_stack = []
 
-        permutation = torch.randperm(N)
         coords = coords[:, permutation]
         x = x[:, :, permutation]
 
-        for lfa in self.encoder:
+        for lfa, knn_output in zip(self.encoder, knn_outputs):
             # at iteration i, x.shape = (B, N//(d**i), d_in)
-            x = lfa(coords[:, : N // decimation_ratio], x)
-            x_stack.append(x.clone())
+            x = lfa(coords[:, : N // decimation_ratio], x, knn_output)
+            x_stack.append(x)
             decimation_ratio *= d
             x = x[:, :, : N // decimation_ratio]
 
@@ -117,15 +167,8 @@ class RandLANet(nn.Module):
         x = self.mlp(x)
 
         # <<<<<<<<<< DECODER
-        for mlp in self.decoder:
-            neighbors, _ = knn(
-                coords[:, : N // decimation_ratio].cpu().contiguous(),  # original set
-                coords[:, : d * N // decimation_ratio]
-                .cpu()
-                .contiguous(),  # upsampled set
-                1,
-            )  # shape (B, N, 1)
-            neighbors = neighbors.to(x.device)
+        for mlp, neighbors in zip(self.decoder, reversed(upsampling_neighbors)):
+            # neighbors: shape (B, N, 1)
             extended_neighbors = neighbors.unsqueeze(1).expand(-1, x.size(1), -1, 1)
 
             x_neighbors = torch.gather(x, -2, extended_neighbors)
@@ -134,19 +177,13 @@ class RandLANet(nn.Module):
 
             x = mlp(x)
 
-            decimation_ratio //= d
-
         # >>>>>>>>>> DECODER
         # inverse permutation
         x = x[:, :, torch.argsort(permutation)]
 
         scores = self.fc_end(x)
 
-        scores = scores.squeeze(-1)  # B, C, N
-        scores = torch.cat(
-            [score_cloud.permute(1, 0) for score_cloud in scores]
-        )  # B*N, C
-        return scores  # B*N, C
+        return scores.squeeze(-1).transpose(1, 2)  # B, N, C
 
     def change_num_class_for_finetuning(self, new_num_classes: int):
         """Change end layer output number of classes if new_num_classes is different.
@@ -160,6 +197,93 @@ class RandLANet(nn.Module):
             self.fc_end[-1] = SharedMLP(32, new_num_classes)
             self.num_classes = new_num_classes
 
+    def set_knn_backend(self, knn_backend: str):
+        """Change the neighbor search backend (see lidar_multiclass.models.modules.knn).
+
+        Args:
+            knn_backend (str): name of the backend.
+
+        """
+        self.knn_function = get_knn_function(knn_backend)
+        for lfa in self.encoder:
+            lfa.knn_function = self.knn_function
+
+    def set_linear_mlp(self, enabled: bool = True):
+        """Switch all shared MLPs to their Linear-based execution path (see SharedMLP.forward_linear).
+
+        Args:
+            enabled (bool): True to use matrix products, False to use 1x1 convolutions.
+
+        """
+        for module in self.modules():
+            if isinstance(module, SharedMLP):
+                module.linear = enabled
+
+
+def search_neighbors(coords, knn_function, num_neighbors, decimation, num_levels):
+    """Search the neighbors used by a RandLANet forward pass. Each search happens once.
+
+    Args:
+        coords (torch.Tensor): (B, N, 3) coordinates, in the random order of the forward pass: the first
+        N // decimation**i points make the point cloud of level i.
+        knn_function (Callable): neighbor search function (see lidar_multiclass.models.modules.knn).
+        num_neighbors (int): number of neighbors of each point in the encoder.
+        decimation (int): ratio of the number of points of two successive levels.
+        num_levels (int): number of encoder levels.
+
+    Returns:
+        List[Tuple[torch.Tensor, torch.Tensor]], List[torch.Tensor]: neighbors (B, N_i, K) indices and squared
+        distances at each level, and (B, N_i, 1) index in level i+1 of the nearest neighbor of each point of level i.
+
+    """
+    N = coords.size(1)
+    knn_outputs = []
+    for level in range(num_levels):
+        level_coords = coords[:, : N // decimation**level]
+        knn_outputs.append(knn_function(level_coords, level_coords, num_neighbors))
+    upsampling_neighbors = [
+        get_upsampling_neighbors(
+            coords[:, : N // decimation ** (level + 1)],
+            coords[:, : N // decimation**level],
+            knn_outputs[level],
+            knn_function,
+        )
+        for level in range(num_levels)
+    ]
+    return knn_outputs, upsampling_neighbors
+
+
+def get_upsampling_neighbors(support, query, knn_output, knn_function):
+    """Get the nearest neighbor in support of each query point, from the neighbors found by the encoder.
+
+    Since support is a prefix of query, the nearest support point is the closest of the query point neighbors
+    with an index below len(support), if any. Query points with no such neighbor are searched for directly.
+
+    Args:
+        support (torch.Tensor): (B, M, 3) coordinates of the original set.
+        query (torch.Tensor): (B, N, 3) coordinates of the upsampled set, of which support is a prefix.
+        knn_output (torch.Tensor, torch.Tensor): (B, N, K) neighbors indices and squared distances in query.
+        knn_function (Callable): neighbor search function.
+
+    Returns:
+        torch.Tensor: (B, N, 1) index in support of the nearest neighbor of each query point.
+
+    """
+    if torch.jit.is_tracing():
+        # The search below depends on the data, which a trace cannot capture.
+        neighbors, _ = knn_function(support, query, 1)
+        return neighbors
+    idx, dist = knn_output
+    in_support = idx < support.size(1)
+    nearest = dist.masked_fill(~in_support, float("inf")).argmin(-1, keepdim=True)
+    neighbors = torch.gather(idx, -1, nearest)
+
+    missing = ~in_support.any(-1)
+    for b in torch.nonzero(missing.any(-1)).flatten().tolist():
+        neighbors_b, _ = knn_function(support[b : b + 1], query[b : b + 1, missing[b]], 1)
+        neighbors[b, missing[b]] = neighbors_b[0]
+    return neighbors
+
 
 class SharedMLP(nn.Module):
     def __init__(
@@ -188,6 +312,9 @@ class SharedMLP(nn.Module):
             nn.BatchNorm2d(out_channels, eps=1e-6, momentum=0.99) if bn else None
         )
         self.activation_fn = activation_fn
+        self.linear = False
+        # int8 replacement of the MLP up to its activation, set by lidar_multiclass.models.quantization.
+        self.quantized = None
 
     def forward(self, input):
         r"""
@@ -199,6 +326,11 @@ class SharedMLP(nn.Module):
             torch.Tensor: with shape (B, d_out, N, K)
 
         """
+        if self.quantized is not None:
+            x = self.quantized(input)
+            return self.activation_fn(x) if self.activation_fn else x
+        if self.linear:
+            return self.forward_linear(input)
         x = self.conv(input)
         if self.batch_norm:
             x = self.batch_norm(x)
@@ -206,55 +338,104 @@ class SharedMLP(nn.Module):
             x = self.activation_fn(x)
         return x
 
+    def forward_linear(self, input):
+        r"""
+        Forward pass of the MLP as a matrix product over the flattened N and K dimensions, which is equivalent
+        to the 1x1 convolution. Out of training, batch normalization is folded into the product.
+        Args:
+            input: torch.Tensor, shape (B, d_in, N, K)
+        Returns:
+            torch.Tensor: with shape (B, d_out, N, K)
+
+        """
+        weight, bias = self.get_linear_parameters()
+        B, _, N, K = input.size()
+        x = torch.matmul(weight, input.reshape(B, -1, N * K))
+        x = (x + bias.view(1, -1, 1)).view(B, -1, N, K)
+        if self.batch_norm and self.training:
+            x = self.batch_norm(x)
+        if self.activation_fn:
+            x = self.activation_fn(x)
+        return x
+
+    def get_linear_parameters(self):
+        """Get weight (d_out, d_in) and bias (d_out) of the MLP, including batch normalization out of training."""
+        assert self.conv.kernel_size == (1, 1) and self.conv.stride == (1, 1)
+        if isinstance(self.conv, nn.ConvTranspose2d):
+            weight = self.conv.weight.flatten(1).t()
+        else:
+            weight = self.conv.weight.flatten(1)
+        bias = self.conv.bias
+        if self.batch_norm and not self.training:
+            bn = self.batch_norm
+            scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+            weight = weight * scale.unsqueeze(1)
+            bias = (bias - bn.running_mean) * scale + bn.bias
+        return weight, bias
+
 
 class LocalSpatialEncoding(nn.Module):
+    """Relative point position encoding.
+
+    The MLP input of each (point, neighbor) pair is the concatenation of the point coordinates c_i, the neighbor
+    coordinates c_j, their difference c_i - c_j and their squared distance (10 channels). Its first layer is
+    linear, so it is computed from per-point projections instead: (W_i + W_d) c_i + (W_j - W_d) c_j + w * dist + b.
+    Only the projections of neighbors are gathered, and the 10-channel input is never materialized.
+
+    """
+
     def __init__(self, d, num_neighbors):
         super(LocalSpatialEncoding, self).__init__()
 
         self.num_neighbors = num_neighbors
         self.mlp = SharedMLP(10, d, bn=True, activation_fn=nn.ReLU())
 
-    def forward(self, coords, features, knn_output):
+    def forward(self, coords, knn_output):
         r"""
         Forward pass
         Parameters
         ----------
         coords: torch.Tensor, shape (B, N, 3)
             coordinates of the point cloud
-        features: torch.Tensor, shape (B, d, N, 1)
-            features of the point cloud
         neighbors: tuple
         Returns
         -------
-        torch.Tensor, shape (B, 2*d, N, K)
+        torch.Tensor, shape (B, d, N, K)
         """
-        # finding neighboring points
         idx, dist = knn_output
-        idx = idx.to(coords.device)
-        dist = dist.to(coords.device)
         B, N, K = idx.size()
-        # idx(B, N, K), coords(B, N, 3)
-        # neighbors[b, i, n, k] = coords[b, idx[b, n, k], i] = extended_coords[b, i, extended_idx[b, i, n, k], k]
-        extended_idx = idx.unsqueeze(1).expand(B, 3, N, K)
-        extended_coords = coords.transpose(-2, -1).unsqueeze(-1).expand(B, 3, N, K)
-        neighbors = torch.gather(extended_coords, 2, extended_idx)  # shape (B, 3, N, K)
-        neighbors = neighbors.to(coords.device)
-
-        # relative point position encoding
-        concat = torch.cat(
-            (
-                extended_coords,
-                neighbors,
-                extended_coords - neighbors,
-                dist.unsqueeze(-3),
-            ),
-            dim=-3,
-        )
-        concat = concat.to(coords.device)
-        return torch.cat((self.mlp(concat), features.expand(B, -1, N, K)), dim=-3)
+        weight = self.mlp.conv.weight.view(-1, 10)
+        w_point, w_neighbor, w_offset, w_dist = torch.split(weight, [3, 3, 3, 1], dim=1)
+
+        # Projections are kept in full precision: offsets between close points would not survive
+        # the difference of two reduced precision projections.
+        with torch.autocast(device_type=coords.device.type, enabled=False):
+            coords = coords.float().transpose(-2, -1)  # shape (B, 3, N)
+            point_projection = torch.matmul(w_point + w_offset, coords)  # shape (B, d, N)
+            point_projection = point_projection + self.mlp.conv.bias.view(1, -1, 1)
+            neighbor_projection = torch.matmul(w_neighbor - w_offset, coords)
+
+            # x[b, i, n, k] = neighbor_projection[b, i, idx[b, n, k]]
+            d = neighbor_projection.size(1)
+            x = torch.gather(
+                neighbor_projection, 2, idx.reshape(B, 1, N * K).expand(B, d, N * K)
+            ).view(B, d, N, K)
+            x = x + point_projection.unsqueeze(-1)
+            x = torch.addcmul(x, w_dist.view(1, d, 1, 1), dist.float().unsqueeze(1))
+
+        x = self.mlp.batch_norm(x)
+        return self.mlp.activation_fn(x)
 
 
 class AttentivePooling(nn.Module):
+    """Attentive pooling of the concatenation of encoded relative positions and point features.
+
+    Point features are the same for all neighbors of a point: their contribution to the attention scores
+    cancels out in the softmax over neighbors, and their pooled value is themselves. Scores are thus only
+    computed for the encoded positions, and features are never expanded to the K neighbors.
+
+    """
+
     def __init__(self, in_channels, out_channels):
         super(AttentivePooling, self).__init__()
 
@@ -264,31 +445,43 @@ class AttentivePooling(nn.Module):
         self.mlp = SharedMLP(
             in_channels, out_channels, bn=True, activation_fn=nn.ReLU()
         )
+        # int8 replacement of the scores product, set by lidar_multiclass.models.quantization.
+        self.quantized_score = None
 
-    def forward(self, x):
+    def forward(self, x, features):
         r"""
         Forward pass
         Parameters
         ----------
-        x: torch.Tensor, shape (B, d_in, N, K)
+        x: torch.Tensor, shape (B, d, N, K)
+            encoded relative positions
+        features: torch.Tensor, shape (B, d_in - d, N, 1)
+            features of the point cloud
         Returns
         -------
         torch.Tensor, shape (B, d_out, N, 1)
         """
         # computing attention scores
-        scores = self.score_fn(x.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
+        B, d, N, K = x.size()
+        if self.quantized_score is not None:
+            scores = self.quantized_score(x)
+        else:
+            weight = self.score_fn[0].weight[:d, :d]
+            scores = torch.matmul(weight, x.reshape(B, d, N * K)).view(B, d, N, K)
+        scores = torch.softmax(scores, dim=-1)
 
         # sum over the neighbors
-        features = torch.sum(scores * x, dim=-1, keepdim=True)  # shape (B, d_in, N, 1)
+        x = torch.sum(scores * x, dim=-1, keepdim=True)  # shape (B, d, N, 1)
 
-        return self.mlp(features)
+        return self.mlp(torch.cat((x, features), dim=1))
 
 
 class LocalFeatureAggregation(nn.Module):
-    def __init__(self, d_in, d_out, num_neighbors):
+    def __init__(self, d_in, d_out, num_neighbors, knn_function=knn_torch_points_kernels):
         super(LocalFeatureAggregation, self).__init__()
 
         self.num_neighbors = num_neighbors
+        self.knn_function = knn_function
 
         self.mlp1 = SharedMLP(d_in, d_out // 2, activation_fn=nn.LeakyReLU(0.2))
         self.mlp2 = SharedMLP(d_out, 2 * d_out)
@@ -302,7 +495,7 @@ class LocalFeatureAggregation(nn.Module):
 
         self.lrelu = nn.LeakyReLU()
 
-    def forward(self, coords, features):
+    def forward(self, coords, features, knn_output=None):
         r"""
         Forward pass
         Parameters
@@ -311,20 +504,18 @@ class LocalFeatureAggregation(nn.Module):
             coordinates of the point cloud
         features: torch.Tensor, shape (B, d_in, N, 1)
             features of the point cloud
+        knn_output: tuple, optional
+            neighbors of the point cloud, searched for if not given
         Returns
         -------
         torch.Tensor, shape (B, 2*d_out, N, 1)
         """
-        # torch_geometric KNN supports CUDA but would need a batch_x and batch_y index tensor.
-        knn_output = knn(
-            coords.cpu().contiguous(), coords.cpu().contiguous(), self.num_neighbors
-        )
+        if knn_output is None:
+            knn_output = self.knn_function(coords, coords, self.num_neighbors)
         x = self.mlp1(features)
 
-        x = self.lse1(coords, x, knn_output)
-        x = self.pool1(x)
+        x = self.pool1(self.lse1(coords, knn_output), x)
 
-        x = self.lse2(coords, x, knn_output)
-        x = self.pool2(x)
+        x = self.pool2(self.lse2(coords, knn_output), x)
 
         return self.lrelu(self.mlp2(x) + self.shortcut(features))
@@ -0,0 +1,215 @@
+"""Post-training int8 quantization of RandLANet for CPU inference, and how it compares to fp32 in IoU by class.
+
+Shared MLPs and attention scores are replaced by int8 1x1 convolutions with batch normalization folded in.
+Activations are quantized with scales calibrated on a few batches of prepared data. Quantizing and dequantizing
+activations is slower than a fp32 product for layers with few channels, which are thus kept in fp32, as are the
+first layer of local spatial encodings (computed from per-point projections of coordinates) and fc_start.
+
+Quantize a checkpoint with `python run.py task.task_name=export predict.quantize_int8=true`, which calibrates on
+prepared val data, logs the IoU of each class and the speed before and after quantization, and saves a TorchScript model to
+use with `predict.exported_model` (see export.py).
+
+"""
+
+import contextlib
+import copy
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import torch
+from torch import nn
+from torch.ao import quantization
+
+from lidar_multiclass.callbacks.logging_callbacks import SingleClassIoU
+from lidar_multiclass.models.modules.randla_net import (
+    AttentivePooling,
+    LocalSpatialEncoding,
+    SharedMLP,
+)
+from lidar_multiclass.utils import utils
+
+log = utils.get_logger(__name__)
+
+QUANTIZATION_ENGINE = "fbgemm"
+# Smallest weight (d_out * d_in) of the layers that are faster in int8 than in fp32 on CPU.
+MIN_QUANTIZED_WEIGHT_SIZE = 2**15
+
+
+@contextlib.contextmanager
+def quantized_engine(engine: str = QUANTIZATION_ENGINE) -> Iterator[None]:
+    """Set the quantized CPU backend, which int8 weights are packed for at conversion and which runs int8
+    operators, and restore the previous one on exit: torch.backends.quantized.engine is global to the process."""
+    previous_engine = torch.backends.quantized.engine
+    torch.backends.quantized.engine = engine
+    try:
+        yield
+    finally:
+        torch.backends.quantized.engine = previous_engine
+
+
+class QuantizedLinear(nn.Module):
+    """A linear layer on (B, d_in, N, K) inputs as a 1x1 convolution between quantization stubs, to be converted
+    to int8 after calibration."""
+
+    def __init__(self, weight: torch.Tensor, bias: Optional[torch.Tensor] = None):
+        """Initialization method.
+
+        Args:
+            weight (torch.Tensor): (d_out, d_in) weight.
+            bias (torch.Tensor, optional): (d_out) bias.
+
+        """
+        super().__init__()
+        d_out, d_in = weight.shape
+        self.quant = quantization.QuantStub()
+        self.conv = nn.Conv2d(d_in, d_out, 1, bias=bias is not None)
+        with torch.no_grad():
+            self.conv.weight.copy_(weight.view(d_out, d_in, 1, 1))
+            if bias is not None:
+                self.conv.bias.copy_(bias)
+        self.dequant = quantization.DeQuantStub()
+
+    def forward(self, input):
+        return self.dequant(self.conv(self.quant(input)))
+
+
+def prepare_int8(
+    net: nn.Module,
+    engine: str = QUANTIZATION_ENGINE,
+    min_weight_size: int = MIN_QUANTIZED_WEIGHT_SIZE,
+) -> nn.Module:
+    """Insert observed QuantizedLinear layers into a RandLANet in eval mode, in place, to be calibrated.
+
+    Args:
+        net (nn.Module): RandLANet in eval mode. Batch normalization is folded with its running statistics.
+        engine (str): quantized CPU backend the observers are configured for. It must also be set when
+        converting, see quantized_engine.
+        min_weight_size (int): layers with a smaller weight are kept in fp32. 0 to quantize all layers.
+
+    """
+    assert not net.training, "Quantization folds batch normalization: net must be in eval mode."
+    qconfig = quantization.get_default_qconfig(engine)
+    # The MLP of local spatial encodings is not run as such (see LocalSpatialEncoding.forward).
+    encoding_mlps = {
+        id(module.mlp) for module in net.modules() if isinstance(module, LocalSpatialEncoding)
+    }
+    quantized_layers: List[QuantizedLinear] = []
+    for module in list(net.modules()):
+        if isinstance(module, SharedMLP) and id(module) not in encoding_mlps:
+            if module.conv.weight.numel() >= min_weight_size:
+                with torch.no_grad():
+                    module.quantized = QuantizedLinear(*module.get_linear_parameters())
+                quantized_layers.append(module.quantized)
+        elif isinstance(module, AttentivePooling):
+            # Scores only use the encoded positions (see AttentivePooling.forward).
+            d = module.score_fn[0].in_features // 2
+            if d * d >= min_weight_size:
+                with torch.no_grad():
+                    module.quantized_score = QuantizedLinear(
+                        module.score_fn[0].weight[:d, :d]
+                    )
+                quantized_layers.append(module.quantized_score)
+    log.info(f"Quantizing {len(quantized_layers)} layers to int8.")
+    for layer in quantized_layers:
+        layer.qconfig = qconfig
+    return quantization.prepare(net, inplace=True)
+
+
+@torch.no_grad()
+def calibrate(net: nn.Module, batches: Iterable) -> None:
+    """Record the range of activations of a prepared network on batches of data."""
+    for batch in batches:
+        net(batch)
+
+
+def convert_int8(net: nn.Module) -> nn.Module:
+    """Convert calibrated QuantizedLinear layers to int8, in place."""
+    return quantization.convert(net, inplace=True)
+
+
+def quantize_int8(
+    net: nn.Module,
+    calibration_batches: Iterable,
+    engine: str = QUANTIZATION_ENGINE,
+    min_weight_size: int = MIN_QUANTIZED_WEIGHT_SIZE,
+) -> nn.Module:
+    """Get an int8 copy of a RandLANet in eval mode, calibrated on batches of data. The network is unchanged.
+
+    The quantized engine is only set while quantizing: run the int8 copy within quantized_engine(engine).
+
+    Args:
+        net (nn.Module): RandLANet in eval mode.
+        calibration_batches (Iterable): batches with pos, x and batch_size, as collated by the datamodule.
+        engine (str): quantized CPU backend.
+        min_weight_size (int): see prepare_int8.
+
+    Returns:
+        nn.Module: quantized network, for CPU inference.
+
+    """
+    with quantized_engine(engine):
+        quantized_net = prepare_int8(copy.deepcopy(net).cpu(), engine, min_weight_size)
+        calibrate(quantized_net, calibration_batches)
+        return convert_int8(quantized_net)
+
+
+@torch.no_grad()
+def compare_to_fp32(
+    net: nn.Module,
+    quantized_net: nn.Module,
+    batches: Iterable,
+    classification_dict: Dict[int, str],
+) -> Dict[str, Any]:
+    """Compare the IoU of each class and the speed of the int8 network to the ones of the fp32 network, with the
+    same batches and points order.
+
+    Args:
+        net (nn.Module): reference network, on CPU.
+        quantized_net (nn.Module): int8 network. Run it within quantized_engine.
+        batches (Iterable): batches with pos, x, y (targets) and batch_size.
+        classification_dict (Dict[int, str]): classes of the model, as in the dataset description.
+
+    Returns:
+        Dict[str, Any]: fp32 IoU, int8 IoU and their difference by class name, and total duration of forward
+        passes for both networks.
+
+    """
+    num_classes = len(classification_dict)
+    ious = {
+        precision: [SingleClassIoU(num_classes, idx) for idx in range(num_classes)]
+        for precision in ["fp32", "int8"]
+    }
+    seconds = {"fp32": 0.0, "int8": 0.0}
+    for batch_idx, batch in enumerate(batches):
+        for precision, neural_net in [("fp32", net), ("int8", quantized_net)]:
+            # RandLANet shuffles points at each forward pass.
+            torch.manual_seed(batch_idx)
+            ts = time.perf_counter()
+            preds = neural_net(batch).argmax(1)
+            seconds[precision] += time.perf_counter() - ts
+            for class_iou in ious[precision]:
+                class_iou.update(preds, batch.y)
+
+    iou_by_class = {}
+    for idx, name in enumerate(classification_dict.values()):
+        fp32 = ious["fp32"][idx].compute().item()
+        int8 = ious["int8"][idx].compute().item()
+        iou_by_class[name] = {"fp32": fp32, "int8": int8, "drift": int8 - fp32}
+    return {
+        "iou_by_class": iou_by_class,
+        "fp32_seconds": seconds["fp32"],
+        "seconds": seconds["int8"],
+    }
+
+
+def log_comparison(metrics: Dict[str, Any]) -> None:
+    """Log a table of the output of compare_to_fp32."""
+    lines = [f"{'class':<20} {'fp32 IoU':>9} {'int8 IoU':>9} {'drift':>8}"]
+    for name, iou in metrics["iou_by_class"].items():
+        lines.append(
+            f"{name:<20} {iou['fp32']:>9.4f} {iou['int8']:>9.4f} {iou['drift']:>+8.4f}"
+        )
+    lines.append(
+        f"Forward passes: {metrics['seconds']:.2f}s in int8 vs {metrics['fp32_seconds']:.2f}s in fp32."
+    )
+    log.info("int8 quantization compared to fp32:\n" + "\n".join(lines))
@@ -1,4 +1,9 @@
+import glob
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Union
+
 import hydra
 import torch
 from omegaconf import DictConfig, OmegaConf
@@ -6,6 +11,8 @@ from pytorch_lightning import LightningDataModule, LightningModule
 from tqdm import tqdm
 
 from lidar_multiclass.utils import utils
+from lidar_multiclass.data.datamodule import LidarIterableDataset
+from lidar_multiclass.export import ExportedModel, OnnxModel
 from lidar_multiclass.models.interpolation import Interpolator
 
 
@@ -13,7 +20,7 @@ log = utils.get_logger(__name__)
 torch.set_grad_enabled(False)
 
 
-def predict(config: DictConfig) -> str:
+def predict(config: DictConfig) -> Union[str, List[str]]:
     """
     Inference pipeline.
 
@@ -24,40 +31,175 @@ def predict(config: DictConfig) -> str:
     point cloud via an Interpolator. This Interpolator also includes the creation of a new LAS file with additional
     dimensions, including predicted classification, entropy, and (optionnaly) predicted probability for each class.
 
+    `config.predict.src_las` can also be a directory or a glob pattern, in which case all matching LAS files
+    are processed with a single model load (see predict_files).
+
     Args:
         config (DictConfig): Configuration composed by Hydra.
 
     Returns:
-        str: path to ouptut LAS.
+        str: path to ouptut LAS, or list of paths to output LAS if src_las is a directory or a glob pattern.
 
     """
 
     # Those are the 2 needed inputs, in addition to the hydra config.
-    assert os.path.exists(config.predict.resume_from_checkpoint)
-    assert os.path.exists(config.predict.src_las)
+    src_las_files = get_src_las_files(config.predict.src_las)
+    datamodule, model, device = load_datamodule_and_model(config)
+
+    out_files = predict_files(src_las_files, datamodule, model, device, config)
+    if os.path.isfile(config.predict.src_las):
+        return out_files[0]
+    return out_files
+
+
+def load_datamodule_and_model(
+    config: DictConfig,
+) -> Tuple[
+    LightningDataModule, Union[LightningModule, ExportedModel, OnnxModel], torch.device
+]:
+    """Instantiate the datamodule, and load the model from checkpoint on the configured device, in eval mode.
+
+    If predict.exported_model is set, the model is loaded from this artifact instead (see export.py).
 
+    """
     datamodule: LightningDataModule = hydra.utils.instantiate(config.datamodule)
-    datamodule._set_predict_data([config.predict.src_las])
+    device = utils.define_device_from_config_param(config.predict.gpus)
+    exported_model = config.predict.get("exported_model")
+    if exported_model and exported_model.endswith(".onnx"):
+        model = OnnxModel(exported_model, config.predict.get("onnx_intra_op_threads", 0))
+        return datamodule, model, device
+    if exported_model:
+        return datamodule, ExportedModel(exported_model, device), device
 
+    assert os.path.exists(config.predict.resume_from_checkpoint)
     model: LightningModule = hydra.utils.instantiate(config.model)
     model = model.load_from_checkpoint(config.predict.resume_from_checkpoint)
-    device = utils.define_device_from_config_param(config.predict.gpus)
     model.to(device)
     model.eval()
+    model.set_inference_mode(
+        precision=config.predict.get("precision", 32),
+        linear_mlp=config.predict.get("linear_mlp", False),
+    )
+    return datamodule, model, device
+
+
+def get_src_las_files(src_las: str) -> List[str]:
+    """Get the LAS files to infer on, from a path to a single file, a directory, or a glob pattern."""
+    if os.path.isdir(src_las):
+        files = glob.glob(os.path.join(src_las, "*.las")) + glob.glob(
+            os.path.join(src_las, "*.laz")
+        )
+    else:
+        files = glob.glob(src_las)
+    files = sorted(files)
+    assert files, f"No LAS file found with src_las={src_las}"
+    return files
+
+
+@torch.no_grad()
+def predict_files(
+    files: List[str],
+    datamodule: LightningDataModule,
+    model: Union[LightningModule, ExportedModel, OnnxModel],
+    device,
+    config: DictConfig,
+) -> List[str]:
+    """Infer on multiple LAS files with an already loaded model.
+
+    Files are processed in a pipeline: the next file is read in a background thread while the current one
+    is inferred on, and the previous one is interpolated and saved in another background thread.
+    Gradients are disabled in the calling thread, which may be the worker thread of serve.py: grad mode
+    is per thread, so that torch.set_grad_enabled(False) at import only applies to the main thread.
+
+    Args:
+        files (List[str]): LAS files to infer on.
+        datamodule (LightningDataModule): datamodule, used to create predict data.
+        model (LightningModule): model, already on device and in eval mode.
+        device: device of the model.
+        config (DictConfig): Configuration composed by Hydra.
+
+    Returns:
+        List[str]: paths to output LAS, in the same order as input files.
 
+    """
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(
+        max_workers=1
+    ) as writer:
+        next_tile = reader.submit(read_tile, files[0], datamodule, config)
+        writes = []
+        for idx, filepath in enumerate(files):
+            dataset, itp, read_time = next_tile.result()
+            if idx + 1 < len(files):
+                next_tile = reader.submit(read_tile, files[idx + 1], datamodule, config)
+
+            ts = time.time()
+            datamodule.predict_data = dataset
+            for batch in tqdm(
+                datamodule.predict_dataloader(), desc=os.path.basename(filepath)
+            ):
+                if batch is None:
+                    continue
+                batch.to(device)
+                batch = datamodule.on_after_batch_transfer(batch, 0)
+                outputs = model.predict_step(batch)
+                itp.update(outputs)
+            inference_time = time.time() - ts
+
+            writes.append(
+                (writer.submit(interpolate_and_save, itp), read_time, inference_time)
+            )
+            # Free the tile, which is kept in the dataset when loaded in shared memory.
+            datamodule.predict_data = None
+
+        out_files = []
+        for filepath, (write, read_time, inference_time) in zip(files, writes):
+            out_f, num_points, write_time = write.result()
+            log.info(
+                f"{os.path.basename(filepath)}: {num_points} points | "
+                f"read {read_time:.1f}s | inference {inference_time:.1f}s | "
+                f"interpolation and saving {write_time:.1f}s | "
+                f"{num_points / inference_time:.0f} points/s for inference"
+            )
+            out_files.append(out_f)
+    return out_files
+
+
+def read_tile(
+    filepath: str, datamodule: LightningDataModule, config: DictConfig
+) -> Tuple[LidarIterableDataset, Interpolator, float]:
+    """Load a LAS to memory, both as predict data and in a new Interpolator.
+
+    Returns:
+        LidarIterableDataset, Interpolator, float: predict data, interpolator, and reading time.
+
+    """
+    ts = time.time()
+    dataset = datamodule._get_predict_data([filepath])
+    if datamodule.num_workers > 1:
+        dataset.load_tiles_in_shared_memory()
     itp = Interpolator(
+        interpolation_k=config.predict.interpolation_k,
         output_dir=config.predict.output_dir,
         classification_dict=datamodule.dataset_description.get("classification_dict"),
         probas_to_save=config.predict.probas_to_save,
+        streaming=config.predict.get("streaming_interpolation", False),
+        overlap_merge=config.predict.get("overlap_merge", "mean"),
     )
+    itp._load_las(filepath)
+    return dataset, itp, time.time() - ts
+
 
-    for batch in tqdm(datamodule.predict_dataloader()):
-        batch.to(device)
-        outputs = model.predict_step(batch)
-        itp.update(outputs)
+def interpolate_and_save(itp: Interpolator) -> Tuple[str, int, float]:
+    """Interpolate and save the predictions accumulated by an Interpolator.
 
+    Returns:
+        str, int, float: path to output LAS, number of points, and duration.
+
+    """
+    ts = time.time()
+    num_points = len(itp.pos_las)
     out_f = itp.interpolate_and_save()
-    return out_f
+    return out_f, num_points, time.time() - ts
 
 
 @hydra.main(config_path="../configs/", config_name="config.yaml")
@@ -0,0 +1,163 @@
+"""A long-lived local inference service, which keeps a model loaded between requests.
+
+Start it with `python run.py task.task_name=serve` and the same configuration as for predictions,
+then request inference on a LAS file with:
+
+    curl -X POST http://127.0.0.1:8080/predict -d '{"src_las": "/path/to/input.las"}'
+
+Requests are answered once the output LAS is saved, with its path and timings. They are processed
+one at a time in arrival order, through a bounded queue: when the queue is full, new requests are
+rejected with a 503 status so that clients can retry later.
+
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import hydra
+import torch
+from omegaconf import DictConfig, OmegaConf
+
+from lidar_multiclass.predict import load_datamodule_and_model, predict_files
+from lidar_multiclass.utils import utils
+
+log = utils.get_logger(__name__)
+torch.set_grad_enabled(False)
+
+
+class InferenceJob:
+    """A request for inference on a single LAS file, and its outcome."""
+
+    def __init__(self, src_las: str):
+        self.src_las = src_las
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.output_path = None
+        self.error = None
+        self.done = threading.Event()
+
+    def to_dict(self) -> dict:
+        return {
+            "src_las": self.src_las,
+            "output_path": self.output_path,
+            "error": self.error,
+            "queue_seconds": round(self.started_at - self.submitted_at, 3),
+            "inference_seconds": round(self.finished_at - self.started_at, 3),
+        }
+
+
+def serve(config: DictConfig) -> None:
+    """Serve inference requests over HTTP until interrupted.
+
+    The model is loaded once. A single worker thread takes jobs from a bounded queue and runs them through
+    the same pipeline as predict.py, so that results match those of the command line.
+
+    Args:
+        config (DictConfig): Configuration composed by Hydra, with a `predict.server` group.
+
+    """
+    datamodule, model, device = load_datamodule_and_model(config)
+    jobs = queue.Queue(maxsize=config.predict.server.max_queue_size)
+
+    def work():
+        while True:
+            job = jobs.get()
+            job.started_at = time.time()
+            try:
+                job.output_path = predict_files(
+                    [job.src_las], datamodule, model, device, config
+                )[0]
+            except Exception as e:
+                log.exception(f"Inference failed for {job.src_las}")
+                job.error = repr(e)
+            job.finished_at = time.time()
+            job.done.set()
+            jobs.task_done()
+
+    threading.Thread(target=work, daemon=True).start()
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/health":
+                return self._respond(404, {"error": f"Unknown path {self.path}"})
+            self._respond(200, {"queue_size": jobs.qsize()})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                return self._respond(404, {"error": f"Unknown path {self.path}"})
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                src_las = json.loads(self.rfile.read(length))["src_las"]
+            except (ValueError, KeyError, TypeError):
+                return self._respond(
+                    400, {"error": 'Expected a json body {"src_las": "/path/to/input.las"}'}
+                )
+            if not os.path.isfile(src_las):
+                return self._respond(400, {"error": f"File not found: {src_las}"})
+
+            job = InferenceJob(src_las)
+            try:
+                jobs.put_nowait(job)
+            except queue.Full:
+                return self._respond(
+                    503,
+                    {"error": "Too many pending requests, retry later."},
+                    headers={"Retry-After": "10"},
+                )
+            job.done.wait()
+            self._respond(500 if job.error else 200, job.to_dict())
+
+        def _respond(self, status: int, body: dict, headers: dict = {}):
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            log.info(f"{self.address_string()} - {format % args}")
+
+    host = config.predict.server.host
+    port = config.predict.server.port
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    log.info(f"Serving inference on http://{host}:{port}/predict")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Shutting down.")
+    finally:
+        server.server_close()
+
+
+@hydra.main(config_path="../configs/", config_name="config.yaml")
+def main(config: DictConfig):
+    """See function {serve.__name__}.
+
+    :meta private:
+
+    """
+    # Imports should be nested inside @hydra.main to optimize tab completion
+    # Read more here: https://github.com/facebookresearch/hydra/issues/934
+    from lidar_multiclass.utils import utils
+    from lidar_multiclass.serve import serve
+
+    utils.extras(config)
+
+    if config.get("print_config"):
+        utils.print_config(config, resolve=False)
+
+    return serve(config)
+
+
+if __name__ == "__main__":
+    # cf. https://github.com/facebookresearch/hydra/issues/1283
+    OmegaConf.register_new_resolver("get_method", hydra.utils.get_method)
+    main()
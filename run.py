@@ -24,6 +24,8 @@ def main(config: DictConfig):
     from lidar_multiclass.utils import utils
     from lidar_multiclass.train import train
     from lidar_multiclass.predict import predict
+    from lidar_multiclass.serve import serve
+    from lidar_multiclass.export import export
 
     # A couple of optional utilities:
     # - disabling python warnings
@@ -43,6 +45,12 @@ def main(config: DictConfig):
     elif config.task.get("task_name") == "predict":
         """Infer probabilities and automate semantic segmentation decisions on unseen data."""
         return predict(config)
+    elif config.task.get("task_name") == "serve":
+        """Keep a model loaded to infer on LAS files requested over a local HTTP endpoint."""
+        return serve(config)
+    elif config.task.get("task_name") == "export":
+        """Export a trained neural network to a standalone TorchScript artifact, for faster inference."""
+        return export(config)
 
 
 if __name__ == "__main__":